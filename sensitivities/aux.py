@@ -14,6 +14,9 @@
     limitations under the License.
 """
 
+import weakref
+from contextlib import contextmanager
+from dataclasses import dataclass
 import pypowsybl.network as nt
 import pypowsybl.loadflow as lf
 import pypowsybl.sensitivity as ss
@@ -30,6 +33,41 @@ MIN_IMPEDANCE = 1E-5
 SENSI_THRESHOLD = 1E-6
 
 
+@dataclass(frozen=True)
+class NetworkSnapshot:
+    """Network data only fetched once per network, cleared by the helpers of this module creating,
+    connecting or disconnecting elements. Being shared by all the variants, it must only hold data
+    that does not depend on the variant (not flows nor connection statuses)
+
+    voltage_levels: voltage levels with columns substation_id, nominal_v and country"""
+    voltage_levels: pd.DataFrame
+
+
+_NETWORK_SNAPSHOTS = weakref.WeakKeyDictionary()
+
+
+def get_network_snapshot(network: nt.Network) -> NetworkSnapshot:
+    """Returns the snapshot of the network, creating it at first call"""
+    snapshot = _NETWORK_SNAPSHOTS.get(network)
+    if snapshot is None:
+        vlvs = network.get_voltage_levels(attributes=["substation_id", "nominal_v"])
+        subs = network.get_substations(attributes=["country"])
+        snapshot = NetworkSnapshot(voltage_levels=vlvs.join(subs, on="substation_id"))
+        _NETWORK_SNAPSHOTS[network] = snapshot
+    return snapshot
+
+
+def clear_network_snapshot(network: nt.Network):
+    """To be called after modifying the network, when it is not done by a helper of this module"""
+    _NETWORK_SNAPSHOTS.pop(network, None)
+
+
+def clip_reactance(x: np.ndarray) -> np.ndarray:
+    """Returns the reactances with an absolute value of at least MIN_IMPEDANCE, keeping their sign
+    (copysign maps x == 0 to +MIN_IMPEDANCE)"""
+    return np.where(np.abs(x) < MIN_IMPEDANCE, np.copysign(MIN_IMPEDANCE, x), x)
+
+
 def adjust_network(network: nt.Network) -> nt.Network:
     """
         Updates network to be coherent with julia's formulation
@@ -39,22 +77,18 @@ def adjust_network(network: nt.Network) -> nt.Network:
     hvdc_lines = network.get_hvdc_lines()
     if len(hvdc_lines) != 0:
         updated_hvdc_lines = pd.DataFrame(
-            index=hvdc_lines.index.to_list(),
-            columns=["r"],
-            data=len(hvdc_lines) * [0.0]
+            {"r": np.zeros(len(hvdc_lines))},
+            index=hvdc_lines.index
         )
         network.update_hvdc_lines(updated_hvdc_lines)
 
     # Remove losses for HVDCs (converter station losses and voltage control)
     vsc_converter_stations = network.get_vsc_converter_stations()
     if len(vsc_converter_stations) != 0:
-        updated_loss_factor_voltage_regulator_on = []
-        for i in range(len(vsc_converter_stations)):
-            updated_loss_factor_voltage_regulator_on.append([0.0, False])
         updated_vsc_converter_stations = pd.DataFrame(
-            index=vsc_converter_stations.index.to_list(),
-            columns=["loss_factor", "voltage_regulator_on"],
-            data=updated_loss_factor_voltage_regulator_on
+            {"loss_factor": np.zeros(len(vsc_converter_stations)),
+             "voltage_regulator_on": np.zeros(len(vsc_converter_stations), dtype=bool)},
+            index=vsc_converter_stations.index
         )
         network.update_vsc_converter_stations(updated_vsc_converter_stations)
 
@@ -62,27 +96,20 @@ def adjust_network(network: nt.Network) -> nt.Network:
     batteries = network.get_batteries()
     if len(batteries) != 0:
         updated_batteries = pd.DataFrame(
-            index=batteries.index.to_list(),
-            columns=["connected"],
-            data=len(batteries) * [False]
+            {"connected": np.zeros(len(batteries), dtype=bool)},
+            index=batteries.index
         )
         network.update_batteries(updated_batteries)
 
     # Update branches (lines/t2wt) after setting a new min impedance
-    def max_impedance_if_needed(x):
-        if abs(x) < MIN_IMPEDANCE:
-            if x >= 0:
-                return MIN_IMPEDANCE
-            return -MIN_IMPEDANCE
-        return x
-
     lines = network.get_lines(attributes=["x"])
-    lines["x"] = lines["x"].apply(max_impedance_if_needed)
+    lines["x"] = clip_reactance(lines["x"].to_numpy())
     network.update_lines(lines)
 
     t2wts = network.get_2_windings_transformers(attributes=["x"])
-    t2wts["x"] = t2wts["x"].apply(max_impedance_if_needed)
+    t2wts["x"] = clip_reactance(t2wts["x"].to_numpy())
     network.update_2_windings_transformers(t2wts)
+    clear_network_snapshot(network)
 
     return network
 
@@ -92,6 +119,8 @@ def hvdc_lines_full_setpoint(network: nt.Network, active_hvdc_lines_ids: list):
     hvdc_angle_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
     hvdc_lines_ids = set(hvdc_angle_droop[hvdc_angle_droop["enabled"]].index)
     hvdc_lines_ids.intersection_update(set(active_hvdc_lines_ids))
+    if len(hvdc_lines_ids) == 0:
+        return
     updated_hvdc_angle_droop = pd.DataFrame(
         index=list(hvdc_lines_ids),
         columns=["enabled"],
@@ -100,6 +129,12 @@ def hvdc_lines_full_setpoint(network: nt.Network, active_hvdc_lines_ids: list):
     network.update_extensions("hvdcAngleDroopActivePowerControl", updated_hvdc_angle_droop)
 
 
+def is_in_countries(countries: pd.Series, country1: str, country2: str) -> np.ndarray:
+    """Returns the mask of the elements of countries that are country1 or country2"""
+    countries = countries.to_numpy()
+    return (countries == country1) | (countries == country2)
+
+
 def enhance_border_hvdc_dataframe(network:nt.Network):
     """Add pertinent information to the hvdc dataframe and returns it.
     
@@ -121,10 +156,7 @@ def enhance_border_hvdc_dataframe(network:nt.Network):
         - 
     """
     hvdcs = network.get_hvdc_lines()
-
-    vlvs = network.get_voltage_levels(attributes=["substation_id", "nominal_v"])
-    subs = network.get_substations(attributes=["country"])
-    vlvs = vlvs.join(subs, on="substation_id")
+    vlvs = get_network_snapshot(network).voltage_levels
 
     vscs = network.get_vsc_converter_stations(attributes=["voltage_level_id", "bus_id", "p", "q"])
     vscs = vscs.join(vlvs, on="voltage_level_id")
@@ -142,14 +174,12 @@ def add_exchange_sign_to_hvdc_df(network:nt.Network, country1:str, country2:str)
         * 1 for flow going effectively from country 1 to country 2
         * -1 for flow going in the opposite direction"""
     hvdcs = enhance_border_hvdc_dataframe(network)
-    hvdcs = hvdcs[(hvdcs["country_or"].isin([country1, country2])) & (hvdcs["country_end"].isin([country1, country2]))]
+    hvdcs = hvdcs[is_in_countries(hvdcs["country_or"], country1, country2) & \
+                  is_in_countries(hvdcs["country_end"], country1, country2)]
     hvdcs_border = hvdcs[hvdcs["country_or"] != hvdcs["country_end"]].copy()
-    hvdcs_border["exchange_sign"] = 0
     # Postivity of this column is defined for an export from country1 to country2
-    hvdcs_border.loc[(hvdcs_border["country_or"] == country1) & \
-                     (hvdcs_border["country_end"] == country2), "exchange_sign"] = 1
-    hvdcs_border.loc[(hvdcs_border["country_or"] == country2) & \
-                     (hvdcs_border["country_end"] == country1), "exchange_sign"] = -1
+    # (border HVDCs only link country1 and country2, so the origin country is enough)
+    hvdcs_border["exchange_sign"] = np.where(hvdcs_border["country_or"].to_numpy() == country1, 1, -1)
 
     # print(hvdcs_border)
     return hvdcs_border
@@ -157,10 +187,21 @@ def add_exchange_sign_to_hvdc_df(network:nt.Network, country1:str, country2:str)
 
 def get_border_countries(network: nt.Network, active_hvdc_lines_ids: list):
     """Returns the country linked by the HVDC lines in the active_hvdc_lines_ids list"""
-    hvdcs = enhance_border_hvdc_dataframe(network)
-    hvdcs = hvdcs.loc[active_hvdc_lines_ids]
+    # Only the countries of the converter stations are needed, not their flows
+    hvdcs = network.get_hvdc_lines(attributes=["converter_station1_id", "converter_station2_id",
+                                               "connected1", "connected2"])
+    hvdcs = hvdcs[hvdcs["connected1"] & hvdcs["connected2"]]
+    hvdc = hvdcs.loc[active_hvdc_lines_ids].iloc[0]
+    vscs = network.get_vsc_converter_stations(attributes=["voltage_level_id"])
+    countries = vscs["voltage_level_id"].map(get_network_snapshot(network).voltage_levels["country"])
+
+    return countries[[hvdc["converter_station1_id"], hvdc["converter_station2_id"]]].to_list()
 
-    return hvdcs[["country_or", "country_end"]].iloc[0].to_list()
+
+def get_first_busbar_by_voltage_level(network: nt.Network) -> pd.Series:
+    """Returns the first busbar section of each voltage level (used for node breaker networks)"""
+    busbar = network.get_busbar_sections(attributes=["voltage_level_id"])
+    return busbar.reset_index().groupby("voltage_level_id")["id"].first()
 
 
 def create_ac_lines_to_simulate_hvdc_ac_emulation(network: nt.Network, active_hvdc_lines_ids: list):
@@ -171,8 +212,14 @@ def create_ac_lines_to_simulate_hvdc_ac_emulation(network: nt.Network, active_hv
     # "converters_mode" "converter_station1_id" "converter_station2_id" "voltage_level_id1"
     # "bus_id1" "voltage_level_id2" "bus_id2" "nominal_v1" "nominal_v2"
 
-    bus_breaker_view = network.get_bus_breaker_view_buses()
-    busbar = network.get_busbar_sections()
+    # Bus breaker buses of a voltage level are matched with the bus id "<voltage_level_id>_<i>",
+    # i being the position of the bus in the voltage level
+    bus_breaker_view = network.get_bus_breaker_view_buses(attributes=["voltage_level_id"]).reset_index()
+    bus_breaker_view["bus_breaker_id"] = bus_breaker_view["voltage_level_id"] + "_" + \
+        bus_breaker_view.groupby("voltage_level_id").cumcount().astype(str)
+    bus_breaker_view = bus_breaker_view.set_index(["voltage_level_id", "bus_breaker_id"])["id"]
+    # Only fetched for node breaker networks
+    first_busbar_by_vl = None
 
     # Convert HVDC lines to AC lines
     hvdc_angle_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
@@ -184,56 +231,49 @@ def create_ac_lines_to_simulate_hvdc_ac_emulation(network: nt.Network, active_hv
     if len(hvdc_lines_ids) == 0:
         return []
 
-    for hvdc_line_id in hvdc_lines_ids:
-        hvdc_line = hvdc_lines.loc[hvdc_line_id]
-
-        # Hvdc positive flow is from RECTIFIER to INVERTER
-        origin_suffix = "_or" if hvdc_line.converters_mode == "SIDE_1_RECTIFIER_SIDE_2_INVERTER" else "_end"
-        end_suffix = "_end" if hvdc_line.converters_mode == "SIDE_1_RECTIFIER_SIDE_2_INVERTER" else "_or"
-
+    # Positions of the hvdc lines, to read their data directly in the column arrays
+    hvdc_lines_pos = hvdc_lines.index.get_indexer(hvdc_lines_ids)
+    if (hvdc_lines_pos < 0).any():
+        raise KeyError(f"HVDC lines {np.array(hvdc_lines_ids)[hvdc_lines_pos < 0]} are not connected")
+    droop_pos = hvdc_angle_droop.index.get_indexer(hvdc_lines_ids)
+
+    # Hvdc positive flow is from RECTIFIER to INVERTER
+    side_1_rectifier = hvdc_lines["converters_mode"].to_numpy()[hvdc_lines_pos] == "SIDE_1_RECTIFIER_SIDE_2_INVERTER"
+    def origin_and_end(column):
+        values_or = hvdc_lines[column + "_or"].to_numpy()[hvdc_lines_pos]
+        values_end = hvdc_lines[column + "_end"].to_numpy()[hvdc_lines_pos]
+        return (np.where(side_1_rectifier, values_or, values_end),
+                np.where(side_1_rectifier, values_end, values_or))
+    voltage_levels_origin, voltage_levels_end = origin_and_end("voltage_level_id")
+    nominal_v_origin, nominal_v_end = origin_and_end("nominal_v")
+    bus_breakers_origin, bus_breakers_end = origin_and_end("bus_id")
+
+    # Droop is given in MW/deg
+    #   Convert to MW/rad
+    #   Then to pu/rad
+    droop = hvdc_angle_droop["droop"].to_numpy()[droop_pos] * 180 / np.pi / 100
+    lines_reactance = 1 / droop * nominal_v_origin * nominal_v_end / 100
+
+    for i, hvdc_line_id in enumerate(hvdc_lines_ids):
         ac_eq_line_id = "ac_eq_line_" + hvdc_line_id
-
-        voltage_level_origin = hvdc_line["voltage_level_id" + origin_suffix]
-        nominal_v_origin = hvdc_line["nominal_v" + origin_suffix]
-        bus_breaker_origin = hvdc_line["bus_id" + origin_suffix]
-        buses_ids_origin = bus_breaker_view[bus_breaker_view["voltage_level_id"] == voltage_level_origin].index.to_list()
-        bus_origin = None
-        for i, bus_id in enumerate(buses_ids_origin):
-            bus_breaker_id = f"{voltage_level_origin}_{i}"
-            if bus_breaker_id == bus_breaker_origin:
-                bus_origin = bus_id
-                break
-
-        voltage_level_end = hvdc_line["voltage_level_id" + end_suffix]
-        nominal_v_end = hvdc_line["nominal_v" + end_suffix]
-        bus_breaker_end = hvdc_line["bus_id" + end_suffix]
-        buses_ids_end = bus_breaker_view[bus_breaker_view["voltage_level_id"] == voltage_level_end].index.to_list()
-        bus_end = None
-        for i, bus_id in enumerate(buses_ids_end):
-            bus_breaker_id = f"{voltage_level_end}_{i}"
-            if bus_breaker_id == bus_breaker_end:
-                bus_end = bus_id
-                break
-
-        # Droop is given in MW/deg
-        #   Convert to MW/rad
-        #   Then to pu/rad
-        droop = hvdc_angle_droop.loc[hvdc_line_id].droop
-        droop *= 180 / np.pi
-        droop /= 100
-        line_reactance = 1 / droop
-        line_reactance *= nominal_v_origin * nominal_v_end / 100
+        voltage_level_origin = voltage_levels_origin[i]
+        voltage_level_end = voltage_levels_end[i]
+        bus_origin = bus_breaker_view.get((voltage_level_origin, bus_breakers_origin[i]))
+        bus_end = bus_breaker_view.get((voltage_level_end, bus_breakers_end[i]))
+        line_reactance = lines_reactance[i]
         try:
             network.create_lines(id=ac_eq_line_id, r=0.0, x=line_reactance,
                                  voltage_level1_id=voltage_level_origin, bus1_id=bus_origin,
                                  connectable_bus1_id=bus_origin, voltage_level2_id=voltage_level_end,
                                  bus2_id=bus_end, connectable_bus2_id=bus_end)
         except PyPowsyblError: # Node breaker network
-            busbar_origin = busbar[busbar["voltage_level_id"] == voltage_level_origin]
-            busbar_end = busbar[busbar["voltage_level_id"] == voltage_level_end]
+            if first_busbar_by_vl is None:
+                first_busbar_by_vl = get_first_busbar_by_voltage_level(network)
             nt.create_line_bays(network, id=ac_eq_line_id,  r=0.0, x=line_reactance,
-                                bus_or_busbar_section_id_1=busbar_origin.index[0], position_order_1=1,
-                                bus_or_busbar_section_id_2=busbar_end.index[0], position_order_2=1)
+                                bus_or_busbar_section_id_1=first_busbar_by_vl.loc[voltage_level_origin],
+                                position_order_1=1,
+                                bus_or_busbar_section_id_2=first_busbar_by_vl.loc[voltage_level_end],
+                                position_order_2=1)
 
     updated_p0 = hvdc_angle_droop.loc[hvdc_lines_ids]["p0"].values
     if network.per_unit:
@@ -244,6 +284,7 @@ def create_ac_lines_to_simulate_hvdc_ac_emulation(network: nt.Network, active_hv
         data=updated_p0
     )
     network.update_hvdc_lines(updated_hvdc_lines)
+    clear_network_snapshot(network)
     return hvdc_lines_ids
 
 
@@ -256,54 +297,47 @@ def add_generators_at_hvdcs_extremities(network: nt.Network, hvdc_list: list):
     hvdc_df = hvdc_df.join(vsc_df, on="converter_station2_id", lsuffix="1", rsuffix="2")
     # print(hvdc_df)
 
-    hvdc_to_fictitious_gen = {}
-    created_gens = []
-    for hvdc_line in hvdc_list:
-        hvdc_to_fictitious_gen[hvdc_line] = {
-            "origin":f'{hvdc_df.loc[hvdc_line, "voltage_level_id1"]}_fict_hvdc_gen',
-            "end":f'{hvdc_df.loc[hvdc_line, "voltage_level_id2"]}_fict_hvdc_gen'
-            }
-        created_gens.append(hvdc_to_fictitious_gen[hvdc_line]["origin"])
+    extremities = hvdc_df.loc[hvdc_list, ["voltage_level_id1", "voltage_level_id2",
+                                          "bus_breaker_bus_id1", "bus_breaker_bus_id2"]]
+    origin_gens = (extremities["voltage_level_id1"] + "_fict_hvdc_gen").to_list()
+    end_gens = (extremities["voltage_level_id2"] + "_fict_hvdc_gen").to_list()
+    hvdc_to_fictitious_gen_df = pd.DataFrame({"origin": origin_gens, "end": end_gens}, index=hvdc_list)
+    # print(hvdc_to_fictitious_gen_df)
+    nb_gens = len(hvdc_list)
+    if nb_gens == 0:
+        return hvdc_to_fictitious_gen_df
+
+    # All origin (resp. end) generators are created at once
+    # (busbar sections are only fetched for node breaker networks)
+    first_busbar_by_vl = None
+    for gen_ids, side in [(origin_gens, "1"), (end_gens, "2")]:
         try:
-            network.create_generators(id=hvdc_to_fictitious_gen[hvdc_line]["origin"],
-                                      voltage_level_id=hvdc_df.loc[hvdc_line, "voltage_level_id1"],
-                                      bus_id=hvdc_df.loc[hvdc_line, "bus_breaker_bus_id1"],
-                                      target_p=0, min_p=-1000,
-                                      max_p=1000, target_q=0,
-                                      voltage_regulator_on=False)
-            network.create_generators(id=hvdc_to_fictitious_gen[hvdc_line]["end"],
-                                      voltage_level_id=hvdc_df.loc[hvdc_line, "voltage_level_id2"],
-                                      bus_id=hvdc_df.loc[hvdc_line, "bus_breaker_bus_id2"],
-                                      target_p=0, min_p=-1000,
-                                      max_p=1000, target_q=0,
-                                      voltage_regulator_on=False)
+            network.create_generators(id=gen_ids,
+                                      voltage_level_id=extremities["voltage_level_id" + side].to_list(),
+                                      bus_id=extremities["bus_breaker_bus_id" + side].to_list(),
+                                      target_p=[0]*nb_gens, min_p=[-1000]*nb_gens,
+                                      max_p=[1000]*nb_gens, target_q=[0]*nb_gens,
+                                      voltage_regulator_on=[False]*nb_gens)
         except PyPowsyblError:
             # Node breaker
-            busbar = network.get_busbar_sections()#.loc[slack_vl_id]
-            busbar_gen1 = busbar[busbar["voltage_level_id"] == hvdc_df.loc[hvdc_line, "voltage_level_id1"]]
-            busbar_gen2 = busbar[busbar["voltage_level_id"] == hvdc_df.loc[hvdc_line, "voltage_level_id2"]]
-            nt.create_generator_bay(network, id=hvdc_to_fictitious_gen[hvdc_line]["origin"],
-                                            max_p=100, min_p=0, voltage_regulator_on=False,
-                                            target_p=0, target_q=0,
-                                            bus_or_busbar_section_id=busbar_gen1.index[0],
-                                            position_order=1)
-            nt.create_generator_bay(network, id=hvdc_to_fictitious_gen[hvdc_line]["end"],
-                                            max_p=100, min_p=0, voltage_regulator_on=False,
-                                            target_p=0, target_q=0,
-                                            bus_or_busbar_section_id=busbar_gen2.index[0],
-                                            position_order=1)
-
-    hvdc_to_fictitious_gen_df = pd.DataFrame.from_dict(hvdc_to_fictitious_gen,orient="index")
-    # print(hvdc_to_fictitious_gen_df)
+            if first_busbar_by_vl is None:
+                first_busbar_by_vl = get_first_busbar_by_voltage_level(network)
+            nt.create_generator_bay(network, id=gen_ids,
+                                    max_p=[100]*nb_gens, min_p=[0]*nb_gens,
+                                    voltage_regulator_on=[False]*nb_gens,
+                                    target_p=[0]*nb_gens, target_q=[0]*nb_gens,
+                                    bus_or_busbar_section_id=first_busbar_by_vl.loc[
+                                        extremities["voltage_level_id" + side]].to_list(),
+                                    position_order=[1]*nb_gens)
+
+    clear_network_snapshot(network)
     return hvdc_to_fictitious_gen_df
 
 
 def calculate_exchange(network:nt.Network, hvdcs_border:pd.DataFrame, country1:str, country2:str):
     """Calculate exchange country1 -> country2, considering that the border HVDC are operated in
     setpoint mode. The exchange is calculated with power values on country1 side"""
-    vlvs = network.get_voltage_levels(attributes=["substation_id"])
-    subs = network.get_substations(attributes=["country"])
-    vlvs = vlvs.join(subs, on="substation_id")
+    vlvs = get_network_snapshot(network).voltage_levels[["substation_id", "country"]]
 
     branches = network.get_branches(attributes=["voltage_level1_id", "voltage_level2_id", "p1", "p2"])
     branches = branches.join(vlvs, on="voltage_level1_id")
@@ -311,29 +345,28 @@ def calculate_exchange(network:nt.Network, hvdcs_border:pd.DataFrame, country1:s
 
     # it may occur that an XNODE is in one country and the end of its only incoming branch is in the other,
     # in this case, this line should not be considered as a border interconnection
-    false_border = []
-    for line in branches[(branches["country_end"] == country1) & (branches["country_or"] == country2)].index:
-        vl = branches.loc[line, "voltage_level2_id"]
-        if len(branches[branches["voltage_level1_id"]== vl]) + len(branches[branches["voltage_level2_id"]== vl]) < 2:
-            false_border.append(vl)
+    # Number of branches connected to each voltage level
+    degree = branches["voltage_level1_id"].value_counts().add(branches["voltage_level2_id"].value_counts(),
+                                                              fill_value=0)
+    candidates = branches[(branches["country_end"] == country1) & (branches["country_or"] == country2)]
+    false_border = candidates.loc[degree.reindex(candidates["voltage_level2_id"]).to_numpy() < 2,
+                                  "voltage_level2_id"].unique()
     branches.loc[branches["voltage_level2_id"].isin(false_border), "country_end"] = country2
-    false_border = []
-    for line in branches[(branches["country_end"] == country2) & (branches["country_or"] == country1)].index:
-        vl = branches.loc[line, "voltage_level1_id"]
-        if len(branches[branches["voltage_level1_id"]== vl]) + len(branches[branches["voltage_level2_id"]== vl]) < 2:
-            false_border.append(vl)
+    candidates = branches[(branches["country_end"] == country2) & (branches["country_or"] == country1)]
+    false_border = candidates.loc[degree.reindex(candidates["voltage_level1_id"]).to_numpy() < 2,
+                                  "voltage_level1_id"].unique()
     branches.loc[branches["voltage_level1_id"].isin(false_border), "country_end"] = country2
 
-    branches = branches[(branches["country_or"].isin([country1, country2])) & (branches["country_end"].isin([country1, country2]))]
-    branches_border = branches[branches["country_or"] != branches["country_end"]].copy()
-    branches_border.loc[branches_border["country_or"] == country1, f"p_{country1}_to_{country2}"] = branches_border["p1"]
-    branches_border.loc[branches_border["country_or"] == country2, f"p_{country1}_to_{country2}"] = branches_border["p2"]
-    ac_exchange = branches_border[f"p_{country1}_to_{country2}"].sum()
-    # print(branches_frontier)
+    branches = branches[is_in_countries(branches["country_or"], country1, country2) & \
+                        is_in_countries(branches["country_end"], country1, country2)]
+    branches_border = branches[branches["country_or"] != branches["country_end"]]
+    # Power flow on country1 side (disconnected elements have NaN flows and are skipped)
+    ac_exchange = np.nansum(np.where(branches_border["country_or"].to_numpy() == country1,
+                                     branches_border["p1"].to_numpy(), branches_border["p2"].to_numpy()))
 
-    hvdcs_border.loc[hvdcs_border["country_or"] == country1, f"p_{country1}_to_{country2}"] = hvdcs_border["p_or"] * hvdcs_border["exchange_sign"]
-    hvdcs_border.loc[hvdcs_border["country_or"] == country2, f"p_{country1}_to_{country2}"] = hvdcs_border["p_end"] * hvdcs_border["exchange_sign"]
-    hvdc_exchange = hvdcs_border[f"p_{country1}_to_{country2}"].sum()
+    hvdc_exchange = np.nansum(np.where(hvdcs_border["country_or"].to_numpy() == country1,
+                                       hvdcs_border["p_or"].to_numpy(), hvdcs_border["p_end"].to_numpy()) * \
+                              hvdcs_border["exchange_sign"].to_numpy())
     if network.per_unit:
         hvdc_exchange *= 100
         ac_exchange *= 100
@@ -345,19 +378,59 @@ def apply_contingency_modification(network: nt.Network, case_name: str,
                                    contingency_element_type: str, hvdc_lines_ac_emulation: set,
                                    status: bool):
     """Open the given line in the network"""
-    if contingency_element_type == "":
-        return
+    apply_contingencies_modification(network, [case_name], [contingency_element_type],
+                                     hvdc_lines_ac_emulation, status)
+
+
+def apply_contingencies_modification(network: nt.Network, case_names: list,
+                                     contingency_element_types: list, hvdc_lines_ac_emulation: set,
+                                     status: bool):
+    """Open (or close if status is True) the given lines in the network, with one update per
+    element type"""
+    elements_ids = {"ac_line": [], "transformer": [], "hvdc_line": []}
+    for case_name, contingency_element_type in zip(case_names, contingency_element_types):
+        if contingency_element_type in elements_ids:
+            elements_ids[contingency_element_type].append(case_name)
+
+    # HVDC line has also an equivalent AC line
+    ac_lines_ids = elements_ids["ac_line"] + ["ac_eq_line_" + hvdc_line_id
+                                              for hvdc_line_id in elements_ids["hvdc_line"]
+                                              if hvdc_line_id in hvdc_lines_ac_emulation]
+    if len(ac_lines_ids) != 0:
+        network.update_branches(id=ac_lines_ids, connected1=[status]*len(ac_lines_ids),
+                                connected2=[status]*len(ac_lines_ids))
+    transformers_ids = elements_ids["transformer"]
+    if len(transformers_ids) != 0:
+        network.update_2_windings_transformers(id=transformers_ids,
+                                               connected1=[status]*len(transformers_ids),
+                                               connected2=[status]*len(transformers_ids))
+    hvdc_lines_ids = elements_ids["hvdc_line"]
+    if len(hvdc_lines_ids) != 0:
+        network.update_hvdc_lines(id=hvdc_lines_ids, connected1=[status]*len(hvdc_lines_ids),
+                                  connected2=[status]*len(hvdc_lines_ids))
+    clear_network_snapshot(network)
+
+
+@contextmanager
+def scoped_variant(network: nt.Network, base_variant_id: str, variant_id: str):
+    """Work on a copy of the base variant, which is set back as working variant (and the copy removed)
+    when leaving the context, even on error"""
+    network.clone_variant(base_variant_id, variant_id)
+    network.set_working_variant(variant_id)
+    try:
+        yield network
+    finally:
+        network.set_working_variant(base_variant_id)
+        network.remove_variant(variant_id)
 
-    if contingency_element_type == "ac_line":
-        network.update_branches(id=case_name, connected1=status, connected2=status)
-    elif contingency_element_type == "transformer":
-        network.update_2_windings_transformers(id=case_name, connected1=status, connected2=status)
-    elif contingency_element_type == "hvdc_line":
-        network.update_hvdc_lines(id=case_name, connected1=status, connected2=status)
-        # HVDC line has also an equivalent AC line
-        if case_name in hvdc_lines_ac_emulation:
-            ac_equivalent_line = "ac_eq_line_" + case_name
-            network.update_branches(id=ac_equivalent_line, connected1=status, connected2=status)
+
+def get_contingency_elements_ids(case_name: str, contingency_element_type: str,
+                                 hvdc_lines_ac_emulation: set) -> list:
+    """Returns the ids of the elements disconnected by the contingency, as opened by
+    apply_contingency_modification (an HVDC line in AC emulation also opens its equivalent AC line)"""
+    if contingency_element_type == "hvdc_line" and case_name in hvdc_lines_ac_emulation:
+        return [case_name, "ac_eq_line_" + case_name]
+    return [case_name]
 
 
 def define_slack_bus(network:nt.Network, slack_vl_id:str, slack_bus_id:str):
@@ -375,24 +448,35 @@ def define_slack_bus(network:nt.Network, slack_vl_id:str, slack_bus_id:str):
         busbar_slack = busbar[busbar["voltage_level_id"] == slack_vl_id]
         nt.create_load_bay(network, id=slack_bus_load_id, p0=0, q0=0, bus_or_busbar_section_id=busbar_slack.index[0], position_order=1)
     network.create_extensions("slackTerminal", voltage_level_id=slack_vl_id, element_id=slack_bus_load_id)
+    clear_network_snapshot(network)
 
 
-def get_branches_limits(network:nt.Network, monitored_branches:set):
-    """Create a dictionnary with the current limits of the monitored branches"""
-    limits = network.get_current_limits()
+def get_branches_limits(network:nt.Network, monitored_branches:list, limits:pd.DataFrame = None):
+    """Create a dictionnary with the current limits of the monitored branches
+    The current limits of the network can be given if they have already been retrieved"""
+    if limits is None:
+        limits = network.get_current_limits()
     # limits = network.get_operational_limits()
-    remaining_branches = monitored_branches.difference(set(limits.index.get_level_values(0)))
+    remaining_branches = set(monitored_branches).difference(limits.index.get_level_values(0))
     print(f"Branches with no defined limits: {remaining_branches}")
 
-    limits = limits.loc[list(monitored_branches.difference(remaining_branches))]
-    # Creating a dictionnary {branch: {limit_name:value}}
-    monitored_branches_limits = limits.groupby(level=0).apply(lambda df: df.xs(df.name)["value"].to_dict()).to_dict()
+    limits = limits[limits.index.get_level_values(0).isin(monitored_branches)]
+    # One value per (branch, limit_name), the last side being kept
+    limits_values = limits.loc[~limits.index.duplicated(keep="last"), "value"]
 
-    for branch, br_limits in monitored_branches_limits.items():
-        min_limit = min(br_limits.values())
-        if br_limits.get("permanent_limit", 10000) > min_limit:
-            br_limits["permanent_limit"] = min_limit
-            print(f"Line {branch} has strange permanent_limit :\n{limits.loc[branch]}")
+    # The permanent limit must be the lowest one
+    min_limits = limits_values.groupby(level=0).min()
+    permanent_limits = limits_values[limits_values.index.get_level_values(1) == "permanent_limit"] \
+        .droplevel(1).reindex(min_limits.index, fill_value=10000)
+    strange_branches = min_limits.index[permanent_limits > min_limits]
+
+    # Creating a dictionnary {branch: {limit_name:value}}
+    monitored_branches_limits = {}
+    for (branch, limit_name), value in zip(limits_values.index, limits_values.to_list()):
+        monitored_branches_limits.setdefault(branch, {})[limit_name] = value
+    for branch in strange_branches:
+        monitored_branches_limits[branch]["permanent_limit"] = min_limits[branch]
+        print(f"Line {branch} has strange permanent_limit :\n{limits.loc[branch]}")
     return monitored_branches_limits
 
 
@@ -402,14 +486,16 @@ def get_pst_data(network:nt.Network, active_psts_ids):
     network.per_unit = False
     pst_df = network.get_phase_tap_changers()
     pst_angles = network.get_phase_tap_changer_steps()
-    pst_dict = {}
-    for pst_name, pst_data in pst_df.loc[active_psts_ids,:].iterrows():
-        alpha_min = pst_angles.loc[(pst_name, pst_data["low_tap"]), "alpha"]
-        alpha_max = pst_angles.loc[(pst_name, pst_data["high_tap"]), "alpha"]
-        if alpha_max < alpha_min:
-            alpha_min, alpha_max = alpha_max, alpha_min
-        alpha_0 = pst_angles.loc[(pst_name, pst_data["tap"]), "alpha"]
-        pst_dict[pst_name] = {"min":alpha_min, "max": alpha_max, "referenceSetpoint":alpha_0}
+    pst_df = pst_df.loc[active_psts_ids, ["low_tap", "high_tap", "tap"]]
+    alpha_low, alpha_high, alpha_0 = (
+        pst_angles.loc[list(zip(pst_df.index, pst_df[tap_column])), "alpha"].to_numpy()
+        for tap_column in ["low_tap", "high_tap", "tap"]
+    )
+    alpha_min = np.minimum(alpha_low, alpha_high).tolist()
+    alpha_max = np.maximum(alpha_low, alpha_high).tolist()
+    alpha_0 = alpha_0.tolist()
+    pst_dict = {pst_name: {"min":alpha_min[i], "max": alpha_max[i], "referenceSetpoint":alpha_0[i]}
+                for i, pst_name in enumerate(pst_df.index)}
     network.per_unit = True
     return pst_dict
 
@@ -426,21 +512,27 @@ def get_hvdc_data(hvdc_df:pd.DataFrame, active_hvdc_lines_ids:list, per_unit=Tru
     pu_ratio = 100 if per_unit else 1
     # target_p is always positive, so here the sign should change depending on which side is INVERTER
     hvdc_df.loc[hvdc_df["converters_mode"] == "SIDE_1_INVERTER_SIDE_2_RECTIFIER", "exchange_sign"] *= -1
+    hvdc_df["signed_target_p"] = hvdc_df["target_p"] * hvdc_df["exchange_sign"]
+    # One row per (merged hvdc, hvdc) pair, summed by merged hvdc
+    merged_hvdcs = pd.Series(hvdc_map, dtype=object).explode()
+    merged_hvdc_df = hvdc_df.loc[merged_hvdcs.to_list(), ["signed_target_p", "max_p"]] \
+        .set_axis(merged_hvdcs.index).groupby(level=0).sum()
     hvdc_dict = {merged_hvdc_name: {
-                            "referenceSetpoint":pu_ratio*sum(hvdc_df.loc[hvdc_name, "target_p"] * \
-                                                        hvdc_df.loc[hvdc_name, "exchange_sign"]
-                                                        for hvdc_name in hvdc_list),
-                            "min": -pu_ratio*sum(hvdc_df.loc[hvdc_name, "max_p"] for hvdc_name in hvdc_list),
-                            "max": pu_ratio*sum(hvdc_df.loc[hvdc_name, "max_p"] for hvdc_name in hvdc_list)
+                            "referenceSetpoint":pu_ratio*merged_hvdc_df.loc[merged_hvdc_name, "signed_target_p"],
+                            "min": -pu_ratio*merged_hvdc_df.loc[merged_hvdc_name, "max_p"],
+                            "max": pu_ratio*merged_hvdc_df.loc[merged_hvdc_name, "max_p"]
                             }
-                        for merged_hvdc_name, hvdc_list in hvdc_map.items()}
+                        for merged_hvdc_name in hvdc_map}
     return hvdc_map, hvdc_dict
 
 
 def launch_sensitivity_analysis(network:nt.Network, monitored_branches_ids:list,
                                 redispatchable_generators_ids:list, active_psts_ids:list,
-                                ac_eq_line_hvdc_lines_ids:list, parameters:lf.Parameters):
-    """Launch sensitivity analysis, with the calculation of four sensitivity matrix"""
+                                ac_eq_line_hvdc_lines_ids:list, parameters:lf.Parameters,
+                                contingencies:dict = None):
+    """Launch sensitivity analysis, with the calculation of four sensitivity matrix
+    The sensitivities are also calculated after each of the contingencies, given as
+    {contingency_id: ids of the elements to disconnect}"""
     analysis = ss.create_ac_analysis()
     analysis.add_factor_matrix(monitored_branches_ids, redispatchable_generators_ids, [],
                                ss.ContingencyContextType.ALL,
@@ -458,40 +550,81 @@ def launch_sensitivity_analysis(network:nt.Network, monitored_branches_ids:list,
                                ss.ContingencyContextType.ALL,
                                ss.SensitivityFunctionType.BRANCH_ACTIVE_POWER_1,
                                ss.SensitivityVariableType.AUTO_DETECT, "psts_ac_eq_line")
+    for contingency_id, elements_ids in (contingencies or {}).items():
+        analysis.add_multiple_elements_contingency(elements_ids, contingency_id)
     # lf.run_ac(network, PARAMS)
     return analysis.run(network, parameters)
 
 
+def is_contingency_converged(result:ss.AcSensitivityAnalysis, contingency_id:str,
+                             matrix_names:list = ("generators", "psts", "generators_ac_eq_line",
+                                                  "psts_ac_eq_line")):
+    """Returns False if the loadflow after the contingency did not converge. The result does not hold
+    any status, but all the reference flows of such contingency are then set to 0"""
+    for matrix_name in matrix_names:
+        reference = result.get_reference_matrix(matrix_name, contingency_id)
+        if reference is not None and np.any(np.nan_to_num(reference.to_numpy(dtype=float)) != 0):
+            return True
+    return False
+
+
+def get_rounded_sensitivity_matrix(result:ss.AcSensitivityAnalysis, matrix_name:str,
+                                   contingency_id:str = None):
+    """Returns the sensitivity matrix (in N, or after the given contingency) rounded to 1e-6,
+    NaN being replaced by 0"""
+    sensitivities_df = result.get_sensitivity_matrix(matrix_name, contingency_id)
+    # Only one copy of the matrix, rounded and filled in place
+    sensitivities = sensitivities_df.to_numpy(dtype=float, copy=True)
+    np.nan_to_num(sensitivities, copy=False, nan=0.0, posinf=np.inf, neginf=-np.inf)
+    np.round(sensitivities, 6, out=sensitivities)
+    return pd.DataFrame(sensitivities, index=sensitivities_df.index, columns=sensitivities_df.columns)
+
+
+def get_hvdc_sensitivities_dataframes(result:ss.AcSensitivityAnalysis, fict_gen:pd.DataFrame,
+                                      generators_to_ct:dict, matrix_name:str, contingency_id:str = None):
+    """Returns the sensitivities of lines on HVDC setpoint variation and on generators injection
+    (dataframes with one column per line), and on counter trading (series by line)"""
+    sensitivities_df = get_rounded_sensitivity_matrix(result, matrix_name, contingency_id)
+    fict_gen = fict_gen.reindex(columns=["origin", "end"])
+    origin_gens = fict_gen["origin"].to_numpy()
+    end_gens = fict_gen["end"].to_numpy()
+    hvdc_sensitivities_df = pd.DataFrame(
+        sensitivities_df.loc[end_gens].to_numpy() - sensitivities_df.loc[origin_gens].to_numpy(),
+        index=fict_gen.index, columns=sensitivities_df.columns)
+    sensitivities_df = sensitivities_df.drop(np.concatenate([origin_gens, end_gens]))
+
+    is_countertrading = sensitivities_df.index.isin(generators_to_ct.keys())
+    countertrading_df = sensitivities_df[is_countertrading]
+    countertrading_coefficient = pd.Series(generators_to_ct, dtype=float).reindex(countertrading_df.index)
+    countertrading = pd.Series(countertrading_coefficient.to_numpy() @ countertrading_df.to_numpy(),
+                               index=countertrading_df.columns)
+    return hvdc_sensitivities_df, sensitivities_df[~is_countertrading], countertrading
+
+
 def get_hvdc_sensitivities_from_generators(result:ss.AcSensitivityAnalysis, fict_gen:pd.DataFrame,
-                                           generators_to_ct:dict, matrix_name:str):
+                                           generators_to_ct:dict, matrix_name:str, contingency_id:str = None):
     """Returns a dictionnary of sensitivities of lines on generators injection and on HVDC setpoint
     variation"""
-    sensitivities_df = result.get_sensitivity_matrix(matrix_name).round(6).fillna(0)
-    hvdc_sensitivities_df = pd.DataFrame(index=fict_gen.index, columns=sensitivities_df.columns)
-    for hvdc_name, hvdc_row in fict_gen.iterrows():
-        summed_col = sensitivities_df.loc[hvdc_row["end"]] - \
-                        sensitivities_df.loc[hvdc_row["origin"]]
-        hvdc_sensitivities_df.loc[hvdc_name] = summed_col.values
-        sensitivities_df.drop(hvdc_row[["origin", "end"]], inplace=True)
-
-    hvdc_sensitivities_dict = hvdc_sensitivities_df.to_dict()
-    countertrading_df = sensitivities_df[sensitivities_df.index.isin(generators_to_ct.keys())]
-    countertrading_coefficient = pd.Series(generators_to_ct)
-    countertrading_dict = countertrading_df.mul(countertrading_coefficient, axis=0).sum().to_dict()
-    gens_sensitivities_dict = sensitivities_df[~sensitivities_df.index.isin(generators_to_ct.keys())].to_dict()
-    return hvdc_sensitivities_dict, gens_sensitivities_dict, countertrading_dict
-
-
-def get_reference_flow_dictionnary(result:ss.AcSensitivityAnalysis, matrix_name:str):
+    hvdc_sensitivities_df, gens_sensitivities_df, countertrading = get_hvdc_sensitivities_dataframes(
+        result, fict_gen, generators_to_ct, matrix_name, contingency_id)
+    return hvdc_sensitivities_df.to_dict(), gens_sensitivities_df.to_dict(), countertrading.to_dict()
+
+
+def get_reference_flow_dataframe(result:ss.AcSensitivityAnalysis, matrix_name:str,
+                                 contingency_id:str = None):
+    """Returns the reference current in a dataframe (one referenceCurrent row)"""
+    branches_reference = result.get_reference_matrix(matrix_name, contingency_id).fillna(0)
+    return branches_reference.rename({"reference_values":"referenceCurrent"})
+
+
+def get_reference_flow_dictionnary(result:ss.AcSensitivityAnalysis, matrix_name:str,
+                                   contingency_id:str = None):
     """Returns the reference current in a dictionnary"""
-    branches_reference = result.get_reference_matrix(matrix_name).fillna(0)
-    branches_reference_dict = branches_reference.rename({"reference_values":"referenceCurrent"}
-                                                        ).to_dict()
-    return branches_reference_dict
+    return get_reference_flow_dataframe(result, matrix_name, contingency_id).to_dict()
 
 
-def get_pst_sensitivities(result:ss.AcSensitivityAnalysis, matrix_name:str):
+def get_pst_sensitivities(result:ss.AcSensitivityAnalysis, matrix_name:str, contingency_id:str = None):
     """Returns the pst sensitivities in a dictionnary"""
-    psts_sensitivities_df = result.get_sensitivity_matrix(matrix_name).round(6).fillna(0)
+    psts_sensitivities_df = get_rounded_sensitivity_matrix(result, matrix_name, contingency_id)
     psts_sensitivities_dict = psts_sensitivities_df.to_dict()
     return psts_sensitivities_dict
@@ -14,19 +14,34 @@
     limitations under the License.
 """
 
+import io
 import os
 import sys
 import json
+import multiprocessing
+import uuid
+import copy
+import itertools
+import tempfile
+from dataclasses import dataclass
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from time import time
 import pypowsybl as pp
 import pypowsybl.loadflow as lf
+from pypowsybl._pypowsybl import PyPowsyblError
 import pandas as pd
+import numpy as np
 from .aux import adjust_network, create_ac_lines_to_simulate_hvdc_ac_emulation
 from .aux import define_slack_bus, get_branches_limits, get_pst_data, get_hvdc_data
 from .aux import apply_contingency_modification, calculate_exchange, get_border_countries
 from .aux import add_generators_at_hvdcs_extremities, hvdc_lines_full_setpoint
-from .aux import get_hvdc_sensitivities_from_generators, get_reference_flow_dictionnary
-from .aux import get_pst_sensitivities, launch_sensitivity_analysis, add_exchange_sign_to_hvdc_df
+from .aux import get_hvdc_sensitivities_dataframes, get_reference_flow_dataframe
+from .aux import get_rounded_sensitivity_matrix, launch_sensitivity_analysis, add_exchange_sign_to_hvdc_df
+from .aux import get_network_snapshot, is_in_countries, get_contingency_elements_ids, is_contingency_converged
+from .aux import scoped_variant
+
+# Newton-Raphson iterations allowed when retrying a case whose loadflow diverged
+RETRY_MAX_ITERATIONS = 1000
 
 # Calculate sensitivities
 
@@ -39,26 +54,23 @@ from .aux import get_pst_sensitivities, launch_sensitivity_analysis, add_exchang
 #   - to redispatchable generators (.csv)
 #   - to active hvdc lines (.csv)
 
-debug = True
-
 def add_proportionnal_redispatching(network:pp.network.Network, country1:str, country2:str):
     """Add all generators with more than 10MW of Pmax to the generators and calculate the
     repartition key for countertrading"""
     gens = network.get_generators(attributes=["name", "target_p", "min_p", "max_p", "voltage_level_id"])
-    vlvs = network.get_voltage_levels(attributes=["substation_id"])
-    subs = network.get_substations(attributes=["country"])
+    vlvs = get_network_snapshot(network).voltage_levels[["country"]]
 
     # Calculating repartition key to change the exchange : the production in country1 increases if the
     # redispatching is positive
     gens = gens[gens["max_p"] > 0.1] # filter for max production > 10 MW
     gens = gens.join(vlvs, on="voltage_level_id")
-    gens = gens.join(subs, on="substation_id")
-    gens = gens[gens["country"].isin([country1, country2])] # filter for production inside pertinent countries
-    gens["repartition_key"] = pd.DataFrame({"diff1": gens["max_p"] - gens["target_p"],
-                                            "diff2": gens["target_p"] - gens["min_p"]}).min(axis=1)
-    gens["repartition_key"] = gens["repartition_key"].clip(lower=0)
-    total_repartition = gens.groupby("country")["repartition_key"].transform("sum")
-    gens["repartition_key"] /= total_repartition
+    gens = gens[is_in_countries(gens["country"], country1, country2)] # filter for production inside pertinent countries
+    target_p = gens["target_p"].to_numpy()
+    # fmin ignores NaN as DataFrame.min does
+    gens["repartition_key"] = np.fmin(gens["max_p"].to_numpy() - target_p,
+                                      target_p - gens["min_p"].to_numpy()).clip(min=0)
+    total_repartition = gens.groupby("country", sort=False)["repartition_key"].sum()
+    gens["repartition_key"] /= gens["country"].map(total_repartition).to_numpy()
     # print(f"Sum of maximal production by country is {repartitions}")
 
     gens.loc[gens["country"] == country2, "repartition_key"] *= -1
@@ -66,21 +78,275 @@ def add_proportionnal_redispatching(network:pp.network.Network, country1:str, co
     # Changing injection
     return gens["repartition_key"].to_dict()
 
+def merge_sensitivities_matrices(matrices:list, counter_trading:dict) -> dict:
+    """Returns {function id: {variable id: value}} from matrices (one row per variable) sharing the same
+    functions, the counter trading sensitivity of each function (0 if not given) being added last
+    The matrices are stacked in one array, instead of being converted to dictionaries one by one"""
+    functions_ids = matrices[0].columns
+    variables_ids = list(itertools.chain.from_iterable(matrix.index for matrix in matrices))
+    values = np.vstack([matrix.reindex(columns=functions_ids).to_numpy(dtype=float) for matrix in matrices])
+    return {function_id: dict(zip(variables_ids, function_values),
+                              counter_trading=counter_trading.get(function_id, 0))
+            for function_id, function_values in zip(functions_ids, values.T.tolist())}
+
+def get_case_sensitivities(result, fict_gen:pd.DataFrame, generators_for_ct:dict,
+                           hvdc_emulation_lines_ids:list, contingency_id:str = None):
+    """Returns the sensitivities of the monitored branches and of the HVDC lines in AC emulation,
+    in N or after the given contingency of the sensitivity analysis result"""
+    hvdc_sensitivities_df, gens_sensitivities_df, ct_sensitivities = \
+        get_hvdc_sensitivities_dataframes(result, fict_gen, generators_for_ct, "generators", contingency_id)
+    branches_sensitivities = merge_sensitivities_matrices(
+        [get_reference_flow_dataframe(result, "generators", contingency_id), gens_sensitivities_df,
+         get_rounded_sensitivity_matrix(result, "psts", contingency_id), hvdc_sensitivities_df],
+        ct_sensitivities.to_dict())
+
+    hvdc_hvdc_sensitivities_df, hvdc_gens_sensitivities_df, _ = \
+        get_hvdc_sensitivities_dataframes(result, fict_gen, generators_for_ct, "generators_ac_eq_line",
+                                          contingency_id)
+    # The counter trading sensitivity is only given for the monitored branches (0 for the HVDC lines)
+    ac_eq_lines_sensitivities = merge_sensitivities_matrices(
+        [get_reference_flow_dataframe(result, "generators_ac_eq_line", contingency_id), hvdc_gens_sensitivities_df,
+         get_rounded_sensitivity_matrix(result, "psts_ac_eq_line", contingency_id), hvdc_hvdc_sensitivities_df],
+        {})
+    ac_eq_sensitivities = {hvdc_name: ac_eq_lines_sensitivities.get("ac_eq_line_" + hvdc_name, {"counter_trading": 0})
+                           for hvdc_name in hvdc_emulation_lines_ids}
+    # print(ac_eq_sensitivities)
+
+    return branches_sensitivities, ac_eq_sensitivities
+
+def run_one_case(network:pp.network.Network, case_name:str, contingency_element_type:str,
+                 monitored_branches_ids:list, redispatchable_generators_ids:list, active_psts_ids:list,
+                 ac_eq_line_hvdc_lines_ids:list, fict_gen:pd.DataFrame, generators_for_ct:dict,
+                 hvdc_emulation_lines_ids:list, parameters:lf.Parameters, debug:bool = False):
+    """Calculate the sensitivities of one case (N or contingency), on a copy of the initial variant
+    Returns the sensitivities of the monitored branches and of the HVDC lines in AC emulation
+    (None if the loadflow does not converge) and the calculation time
+    If the sensitivity analysis fails, it is first retried with more iterations if its loadflow only
+    reached the maximum number of iterations, and else the contingency is reapplied and the
+    loadflow rerun. The loadflow is also run beforehand in debug mode"""
+    current_time = time()
+    # The contingency is applied on a copy of the initial variant
+    with scoped_variant(network, "InitialState", f"contingency_{case_name}"):
+        apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, False)
+        if debug:
+            lf_res = lf.run_ac(network, parameters)
+            print(f"Result of Loadflow is {lf_res}")
+        try:
+            result = launch_sensitivity_analysis(network, monitored_branches_ids,
+                                                 redispatchable_generators_ids, active_psts_ids,
+                                                 ac_eq_line_hvdc_lines_ids, parameters)
+        except PyPowsyblError as error:
+            # The base loadflow of the sensitivity analysis did not converge
+            print(f"\n\n\n\n/!\\ Contingency {case_name} does not allow to calculate any sensitivities ({error})... retrying /!\\ \n\n\n\n")
+            result = None
+            if "MAX_ITERATION_REACHED" in str(error):
+                # Cheap retry first, only allowing more iterations to the loadflow that did not diverge
+                try:
+                    result = launch_sensitivity_analysis(network, monitored_branches_ids,
+                                                         redispatchable_generators_ids, active_psts_ids,
+                                                         ac_eq_line_hvdc_lines_ids,
+                                                         with_max_iterations(parameters, RETRY_MAX_ITERATIONS))
+                except PyPowsyblError:
+                    pass
+            if result is None:
+                apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, True)
+                print(f"Back to normal?: {lf.run_ac(network, parameters)}")
+                apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, False)
+                lf_res_2 = lf.run_ac(network, parameters)
+                if lf_res_2[0].status != lf.ComponentStatus.CONVERGED:
+                    print(f"Still not working, status is {lf_res_2[0]} : skiping")
+                    return None, None, time() - current_time
+                result = launch_sensitivity_analysis(network, monitored_branches_ids,
+                                                     redispatchable_generators_ids, active_psts_ids,
+                                                     ac_eq_line_hvdc_lines_ids, parameters)
+
+    branches_sensitivities, ac_eq_sensitivities = get_case_sensitivities(result, fict_gen, generators_for_ct,
+                                                                         hvdc_emulation_lines_ids)
+    return branches_sensitivities, ac_eq_sensitivities, time() - current_time
+
+def run_cases(network:pp.network.Network, case_names:list, contingency_element_types:list,
+              monitored_branches_ids:list, redispatchable_generators_ids:list, active_psts_ids:list,
+              ac_eq_line_hvdc_lines_ids:list, fict_gen:pd.DataFrame, generators_for_ct:dict,
+              hvdc_emulation_lines_ids:list, parameters:lf.Parameters, debug:bool = False):
+    """Calculate the sensitivities of several cases with one sensitivity analysis, the contingencies
+    being simulated by the analysis itself. Returns the results of run_one_case for each case, the time
+    of the analysis being shared between the cases
+    The cases whose loadflow does not converge (or all of them if the N loadflow does not converge)
+    are calculated again one by one with run_one_case, as all the cases in debug mode or if the slack
+    bus is not read from the network (the analysis selecting it on the N topology only, instead of
+    the topology of each contingency)"""
+    case_parameters = {
+        "monitored_branches_ids":monitored_branches_ids,
+        "redispatchable_generators_ids":redispatchable_generators_ids,
+        "active_psts_ids":active_psts_ids,
+        "ac_eq_line_hvdc_lines_ids":ac_eq_line_hvdc_lines_ids,
+        "fict_gen":fict_gen,
+        "generators_for_ct":generators_for_ct,
+        "hvdc_emulation_lines_ids":hvdc_emulation_lines_ids,
+        "parameters":parameters,
+        "debug":debug
+        }
+    if debug or not parameters.read_slack_bus:
+        return [run_one_case(network, case_name, contingency_element_type, **case_parameters)
+                for case_name, contingency_element_type in zip(case_names, contingency_element_types)]
+
+    current_time = time()
+    contingencies = {case_name: get_contingency_elements_ids(case_name, contingency_element_type,
+                                                             hvdc_emulation_lines_ids)
+                     for case_name, contingency_element_type in zip(case_names, contingency_element_types)
+                     if case_name != "N"}
+    try:
+        result = launch_sensitivity_analysis(network, monitored_branches_ids, redispatchable_generators_ids,
+                                             active_psts_ids, ac_eq_line_hvdc_lines_ids, parameters,
+                                             contingencies)
+    except PyPowsyblError as error:
+        print(f"/!\\ N loadflow does not converge ({error}), the cases are calculated one by one /!\\")
+        result = None
+
+    cases_results = []
+    retry_time = 0
+    for case_name, contingency_element_type in zip(case_names, contingency_element_types):
+        contingency_id = None if case_name == "N" else case_name
+        if result is not None and is_contingency_converged(result, contingency_id):
+            cases_results.append((*get_case_sensitivities(result, fict_gen, generators_for_ct,
+                                                          hvdc_emulation_lines_ids, contingency_id), 0))
+        else:
+            case_result = run_one_case(network, case_name, contingency_element_type, **case_parameters)
+            retry_time += case_result[2]
+            cases_results.append(case_result)
+    # The time of the sensitivity analysis is shared between the cases
+    analysis_time = (time() - current_time - retry_time) / len(cases_results)
+    return [(branches_sensitivities, ac_eq_sensitivities, case_time + analysis_time)
+            for branches_sensitivities, ac_eq_sensitivities, case_time in cases_results]
+
+
+# Network of the worker process (and its key), when the cases are calculated in parallel
+WORKER_NETWORK = None
+WORKER_NETWORK_KEY = None
+
+def init_worker_network(network_buffer:bytes, network_key:str = None):
+    """Load the network sent by the main process (serialized in XIIDM)"""
+    global WORKER_NETWORK, WORKER_NETWORK_KEY
+    WORKER_NETWORK = pp.network.load_from_binary_buffer(io.BytesIO(network_buffer))
+    WORKER_NETWORK.per_unit = True
+    WORKER_NETWORK_KEY = network_key
+
+def run_cases_in_worker(case_names:list, contingency_element_types:list, case_parameters:dict):
+    """Calculate a batch of cases on the network of the worker process"""
+    return run_cases(WORKER_NETWORK, case_names, contingency_element_types, **case_parameters)
+
+def check_executor(executor:Executor):
+    """Raises a ValueError if the executor runs its tasks in threads, that would share the network of
+    the worker process (and its working variant), or in forked processes: the forked copy of the
+    pypowsybl native runtime crashes (Fatal error: Pthread.joinNoTransition)"""
+    if isinstance(executor, ThreadPoolExecutor):
+        raise ValueError("The tasks must be run in separate processes, not by a ThreadPoolExecutor")
+    # The start method of the pool is not exposed otherwise
+    if isinstance(executor, ProcessPoolExecutor) and executor._mp_context.get_start_method() == "fork":
+        raise ValueError("The processes of the executor must not be forked, create it with "
+                         "mp_context=multiprocessing.get_context(\"spawn\")")
+
+def sensitivity_task(network_key:str, network_buffer:bytes, case_names:list, contingency_element_types:list,
+                     case_parameters:dict):
+    """Calculate a batch of cases from the serialized network, so that the task only depends on its
+    inputs and can be scheduled by any executor. Each process loads the network identified by
+    network_key only once"""
+    if WORKER_NETWORK_KEY != network_key:
+        init_worker_network(network_buffer, network_key)
+    return run_cases_in_worker(case_names, contingency_element_types, case_parameters)
+
+JSON_INDENT = 4
+
+class JSONFragment(str):
+    """Value that has already been serialized to JSON by to_json_fragment"""
+
+def to_json_fragment(value, pretty:bool = True) -> JSONFragment:
+    """Serialize a value to be written later by write_json, with sorted keys and JSON_INDENT
+    indentation if pretty, else compact"""
+    if pretty:
+        return JSONFragment(json.dumps(value, indent=JSON_INDENT, sort_keys=True))
+    return JSONFragment(json.dumps(value, sort_keys=True, separators=(",", ":")))
+
+@dataclass(frozen=True)
+class SpooledJSONFragment:
+    """JSONFragment written in a temporary file by spool_json_fragment, only its position being kept"""
+    file: io.BufferedRandom
+    offset: int
+    length: int
+
+    def read(self) -> JSONFragment:
+        """Returns the fragment read back from the temporary file"""
+        self.file.seek(self.offset)
+        return JSONFragment(self.file.read(self.length).decode())
+
+def spool_json_fragment(fragments_file:io.BufferedRandom, fragment:JSONFragment) -> SpooledJSONFragment:
+    """Write the fragment at the end of the (binary) temporary file, to be written later by write_json"""
+    offset = fragments_file.seek(0, io.SEEK_END)
+    data = fragment.encode()
+    fragments_file.write(data)
+    return SpooledJSONFragment(fragments_file, offset, len(data))
+
+def write_json(json_file, value, level:int = 0, pretty:bool = True):
+    """Write a value to an opened file as json.dump(value, json_file, indent=JSON_INDENT, sort_keys=True)
+    would (or without indentation if not pretty), without building the whole document in memory.
+    The dictionaries are written key by key and the JSONFragment values as they are (the
+    SpooledJSONFragment ones being read back from their temporary file)"""
+    if isinstance(value, dict) and len(value) != 0:
+        indent = "\n" + " " * (JSON_INDENT * (level + 1)) if pretty else ""
+        key_separator = ": " if pretty else ":"
+        json_file.write("{")
+        for i, key in enumerate(sorted(value)):
+            json_file.write(f"{',' if i else ''}{indent}{json.dumps(key)}{key_separator}")
+            write_json(json_file, value[key], level + 1, pretty)
+        json_file.write(("\n" + " " * (JSON_INDENT * level) if pretty else "") + "}")
+        return
+    if isinstance(value, SpooledJSONFragment):
+        value = value.read()
+    if not isinstance(value, JSONFragment):
+        value = to_json_fragment(value, pretty)
+    if pretty:
+        value = value.replace("\n", "\n" + " " * (JSON_INDENT * level))
+    json_file.write(value)
+
+def read_csv_column(csv_path:str, column:str) -> pd.Series:
+    """Read the ids of one column of a csv, without parsing (nor inferring the type of) the other columns"""
+    return pd.read_csv(csv_path, usecols=[column], dtype={column:str})[column]
+
 # Parameters
-PARAMS = lf.Parameters(
-    read_slack_bus=True,
-    distributed_slack=False,
-    connected_component_mode=lf.ConnectedComponentMode.MAIN,
-    voltage_init_mode=lf.VoltageInitMode.DC_VALUES,
-    provider_parameters={"maxNewtonRaphsonIterations":"500"}
-)
+def with_max_iterations(parameters:lf.Parameters, max_iterations:int) -> lf.Parameters:
+    """Returns a copy of the loadflow parameters allowing max_iterations Newton-Raphson iterations"""
+    parameters = copy.deepcopy(parameters)
+    parameters.provider_parameters["maxNewtonRaphsonIterations"] = str(max_iterations)
+    return parameters
+
+def make_params(read_slack_bus:bool = True, distributed_slack:bool = False) -> lf.Parameters:
+    """Returns new loadflow parameters, that can be modified without impacting any other calculation"""
+    return lf.Parameters(
+        read_slack_bus=read_slack_bus,
+        distributed_slack=distributed_slack,
+        connected_component_mode=lf.ConnectedComponentMode.MAIN,
+        voltage_init_mode=lf.VoltageInitMode.DC_VALUES,
+        provider_parameters={"maxNewtonRaphsonIterations":"500"}
+    )
 
 def main(data_folder:str, network_path:str, monitored_branches_path:str, contingencies_path:str,
          active_hvdc_lines_path:str, active_psts_path:str = None, slack_bus_path:str = None,
          redispatchable_generators_path:str = None, hvdc_target:float = None,
-         force_setpoint:bool = False, maximum_counter_trading:float = 0):
+         force_setpoint:bool = False, maximum_counter_trading:float = 0, n_procs:int = 1,
+         executor:Executor = None, debug:bool = False, pretty:bool = False, batch_size:int = None,
+         n_workers:int = None):
     """Load network and csvs with branch_ids (monitored and contingencies)
-    Add contingencies to monitored_branches if they are not already present"""
+    Add contingencies to monitored_branches if they are not already present
+    The cases are calculated in parallel by n_procs processes if n_procs > 1, or submitted as
+    independent tasks to the given executor, running them in separate processes that are not forked
+    (pypowsybl does not support it): a ProcessPoolExecutor with a "spawn" (or "forkserver")
+    mp_context, or a dask distributed Client (the network then being scattered once to its workers)
+    The contingencies are simulated by batches of batch_size cases in one sensitivity analysis, by
+    default one batch for each of the n_workers workers of the executor (n_workers or batch_size
+    must then be given), or for each of the n_procs processes
+    In debug mode, the DC exchange is printed, and the AC loadflow of each case is run and printed
+    before its sensitivity analysis
+    The output json is indented only if pretty, to be read by humans"""
 
     timers = {}
     current_time = time()
@@ -92,7 +358,7 @@ def main(data_folder:str, network_path:str, monitored_branches_path:str, conting
     # AC line reactance equals 1 / droop and updates the target to be the one from extension
     # INFO: only applies to hvdc lines in which the extension hvdcAngleDroopActivePowerControl is enabled
     # On the contrary, if the setpoint mode is forced the AC emulation of all HVDCs is deactivated
-    active_hvdc_lines_ids = pd.read_csv(active_hvdc_lines_path)["hvdc_line_id"].to_list()
+    active_hvdc_lines_ids = read_csv_column(active_hvdc_lines_path, "hvdc_line_id").to_list()
     if force_setpoint:
         hvdc_emulation_lines_ids = set()
     else:
@@ -107,38 +373,38 @@ def main(data_folder:str, network_path:str, monitored_branches_path:str, conting
         hvdc_target_list = [hvdc_target] * len(active_hvdc_lines_ids)
         network.update_hvdc_lines(id=active_hvdc_lines_ids, target_p=hvdc_target_list)
 
-    # Network elements
-    network_branches_ids = set(network.get_branches().index)
-    network_hvdc_lines_ids = set(network.get_hvdc_lines().index)
-    twowd_transformers = network.get_2_windings_transformers().index
+    # Network elements, retrieved once and reused below
+    network_branches_ids = network.get_branches(attributes=[]).index
+    network_hvdc_lines_ids = network.get_hvdc_lines(attributes=[]).index
+    twowd_transformers = network.get_2_windings_transformers(attributes=[]).index
+    current_limits = network.get_current_limits()
 
     # Monitored branches
-    monitored_branches_ids = set(pd.read_csv(monitored_branches_path)["branch_id"])
-    if len(monitored_branches_ids) == 0:
+    monitored_branches = read_csv_column(monitored_branches_path, "branch_id")
+    if len(monitored_branches) == 0:
         raise ValueError("No monitored branch is present on the network. Add monitored branches that are present in the network in monitored_branches.csv")
-    monitored_branches_ids.intersection_update(network_branches_ids)
-
-    # Contingencies
-    contingencies = pd.read_csv(contingencies_path)
-    contingencies_ac_lines_ids = set(contingencies[contingencies["element_type"] == "ac_line"]["element_id"])
-    contingencies_hvdc_lines_ids = set(contingencies[contingencies["element_type"] == "hvdc_line"]["element_id"])
-    contingencies_transformer_ids = set(contingencies[contingencies["element_type"] == "transformer"]["element_id"])
-
-    # Filter for contingencies in the network
-    contingencies_ac_lines_ids.intersection_update(network_branches_ids)
-    contingencies_hvdc_lines_ids.intersection_update(network_hvdc_lines_ids)
-    contingencies_transformer_ids.intersection_update(twowd_transformers)
-
+    monitored_branches_ids = monitored_branches[monitored_branches.isin(network_branches_ids)].unique().tolist()
+
+    # Contingencies, filtered for contingencies in the network
+    contingencies = pd.read_csv(contingencies_path, usecols=["element_id", "element_type"],
+                                dtype={"element_id":str, "element_type":"category"})
+    # Split by element type in a single pass
+    contingencies_by_type = dict(tuple(contingencies.groupby("element_type", observed=True, sort=False)["element_id"]))
+    def contingencies_ids(element_type, network_elements_ids):
+        element_ids = contingencies_by_type.get(element_type, pd.Series(dtype=str))
+        return element_ids[element_ids.isin(network_elements_ids)].unique().tolist()
+    contingencies_ac_lines_ids = contingencies_ids("ac_line", network_branches_ids)
+    contingencies_hvdc_lines_ids = contingencies_ids("hvdc_line", network_hvdc_lines_ids)
+    contingencies_transformer_ids = contingencies_ids("transformer", twowd_transformers)
 
     # Calculate sensis with respect to redispatchable generators
     if redispatchable_generators_path is not None:
-        redispatchable_generators_ids = pd.read_csv(redispatchable_generators_path)["generator_id"].to_list()
+        redispatchable_generators_ids = read_csv_column(redispatchable_generators_path, "generator_id").to_list()
     else:
         redispatchable_generators_ids = []
 
     if maximum_counter_trading > 0:
         generators_for_ct = add_proportionnal_redispatching(network, country1, country2)
-        redispatchable_generators_ids = list(set(redispatchable_generators_ids).union(generators_for_ct.keys()))
         # print(f"Countertrading ratios : {generators_for_ct}")
         counter_trading_info = {"counter_trading": {
                 "min":-maximum_counter_trading,
@@ -150,7 +416,7 @@ def main(data_folder:str, network_path:str, monitored_branches_path:str, conting
 
     # Calculate sensis with respect to active psts
     if active_psts_path is not None:
-        active_psts_ids = pd.read_csv(active_psts_path)["pst_id"].to_list()
+        active_psts_ids = read_csv_column(active_psts_path, "pst_id").to_list()
     else:
         active_psts_ids = []
     # Change regulation mode of active psts
@@ -161,24 +427,25 @@ def main(data_folder:str, network_path:str, monitored_branches_path:str, conting
 
     # Define slack bus
     if slack_bus_path is not None:
-        slack_bus = pd.read_csv(slack_bus_path).iloc[0]
+        slack_bus = pd.read_csv(slack_bus_path, usecols=["voltage_level_id", "bus_id"], dtype=str, nrows=1).iloc[0]
         slack_bus_voltage_level_id = slack_bus["voltage_level_id"]
         slack_bus_bus_id = slack_bus["bus_id"]
         define_slack_bus(network, slack_bus_voltage_level_id, slack_bus_bus_id)
-    else:
-        PARAMS.read_slack_bus = False
+    params = make_params(read_slack_bus=slack_bus_path is not None)
 
     timers["network_update"] = time() - current_time
     current_time = time()
 
 
-    dc_lf = lf.run_dc(network, PARAMS)
-    print(f"DC loadflow gives {dc_lf}")
-    hvdc_df = add_exchange_sign_to_hvdc_df(network, country1, country2)
-    print(f"DC exchange levels are {calculate_exchange(network, hvdc_df, country1, country2)}")
+    if debug:
+        # The DC exchange is only printed
+        dc_lf = lf.run_dc(network, params)
+        print(f"DC loadflow gives {dc_lf}")
+        hvdc_df = add_exchange_sign_to_hvdc_df(network, country1, country2)
+        print(f"DC exchange levels are {calculate_exchange(network, hvdc_df, country1, country2)}")
 
 
-    ac_lf = lf.run_ac(network, PARAMS)
+    ac_lf = lf.run_ac(network, params)
     print(f"Initial AC loadflow is {ac_lf}")
     hvdc_df = add_exchange_sign_to_hvdc_df(network, country1, country2)
     situation_description = calculate_exchange(network, hvdc_df, country1, country2)
@@ -199,109 +466,118 @@ def main(data_folder:str, network_path:str, monitored_branches_path:str, conting
 
     # Add fictitious generators at extremities of controllable HVDCs
     fict_gen = add_generators_at_hvdcs_extremities(network, list(hvdc_map.keys()))
-    redispatchable_generators_ids += set(fict_gen["origin"])
-    redispatchable_generators_ids += set(fict_gen["end"])
+    # Without duplicates, in the order they are first given (for reproducible results)
+    redispatchable_generators_ids = list(dict.fromkeys([*redispatchable_generators_ids, *generators_for_ct,
+                                                        *fict_gen["origin"], *fict_gen["end"]]))
 
     # Get values of line current limits
-    quad_limits = get_branches_limits(network, monitored_branches_ids)
-    monitored_branches_ids = list(monitored_branches_ids)
-
-    cases = ["N"] + list(contingencies_ac_lines_ids) + list(contingencies_hvdc_lines_ids) + \
-            list(contingencies_transformer_ids)
-    contingency_element_types = [""] + len(contingencies_ac_lines_ids) * ["ac_line"] + \
-                                len(contingencies_hvdc_lines_ids) * ["hvdc_line"] + \
-                                len(contingencies_transformer_ids) * ["transformer"]
-
-    current_time = time()
-    initial_name = "InitialState"
-    branches_sensitivities = {branch_name:{} for branch_name in monitored_branches_ids}
-    ac_eq_sensitivities = {hvdc_line:{} for hvdc_line in hvdc_emulation_lines_ids}
-    for (case_name, contingency_element_type) in zip(cases, contingency_element_types):
-        # Apply contingency
-        print(f"Contingency is {case_name} / {contingency_element_type}", end="    ")
-        network.clone_variant(initial_name, "current_contingency")
-        network.set_working_variant("current_contingency")
-        apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, False)
-        if debug:
-            lf_res = lf.run_ac(network, PARAMS)
-            # print(f"Result of Loadflow is {lf_res}")
-            if lf_res[0].status != lf.ComponentStatus.CONVERGED:
-                print(f"\n\n\n\n/!\\ Contingency {case_name} does not allow to calculate any sensitivities... retrying /!\\ \n\n\n\n")
-                apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, True)
-                print(f"Back to normal?: {lf.run_ac(network, PARAMS)}")
-                apply_contingency_modification(network, case_name, contingency_element_type, hvdc_emulation_lines_ids, False)
-                lf_res_2 = lf.run_ac(network, PARAMS)
-                if lf_res_2[0].status != lf.ComponentStatus.CONVERGED:
-                    print(f"Still not working, status is {lf_res_2[0]} : skiping")
-                    timers[f"Sensi for {case_name}"] = time() - current_time
-                    current_time = time()
-                    continue
-
-        result = launch_sensitivity_analysis(network, monitored_branches_ids,
-                                             redispatchable_generators_ids, active_psts_ids,
-                                             ac_eq_line_hvdc_lines_ids, PARAMS)
-
-        hvdc_sensitivities_dict, gens_sensitivities_dict, ct_sensitivities_dict = \
-            get_hvdc_sensitivities_from_generators(result, fict_gen, generators_for_ct, "generators")
-
-        hvdc_hvdc_sensitivities_dict, hvdc_gens_sensitivities_dict, hvdc_ct_sensitivities_dict = \
-            get_hvdc_sensitivities_from_generators(result, fict_gen, generators_for_ct, "generators_ac_eq_line")
-
-        branches_reference_dict = get_reference_flow_dictionnary(result, "generators")
-        psts_sensitivities_dict = get_pst_sensitivities(result, "psts")
-        hvdc_reference_dict = get_reference_flow_dictionnary(result, "generators_ac_eq_line")
-        hvdc_psts_sensitivities_dict = get_pst_sensitivities(result, "psts_ac_eq_line")
-
-        for branch_name, ref_current in branches_reference_dict.items():
-            branches_sensitivities[branch_name][case_name] = ref_current
-            for dic_to_add in [gens_sensitivities_dict, psts_sensitivities_dict,
-                               hvdc_sensitivities_dict]:
-                branches_sensitivities[branch_name][case_name].update(dic_to_add.get(branch_name, {}))
-            branches_sensitivities[branch_name][case_name]["counter_trading"] = \
-                ct_sensitivities_dict.get(branch_name, 0)
- 
-        for hvdc_name in hvdc_emulation_lines_ids:
-            hvdc_eq_line = "ac_eq_line_" + hvdc_name
-            ac_eq_sensitivities[hvdc_name][case_name] = {}
-            for dic_to_add in [hvdc_reference_dict, hvdc_gens_sensitivities_dict,
-                               hvdc_psts_sensitivities_dict, hvdc_hvdc_sensitivities_dict]:
-                ac_eq_sensitivities[hvdc_name][case_name].update(dic_to_add.get(hvdc_eq_line, {}))
-            ac_eq_sensitivities[hvdc_name][case_name]["counter_trading"] = \
-                hvdc_ct_sensitivities_dict.get(hvdc_name, 0)
-        # print(ac_eq_sensitivities)
-
-        # Undo contingency
-        network.set_working_variant(initial_name)
-        timers[f"Sensi for {case_name}"] = time() - current_time
-        print(f"{timers[f'Sensi for {case_name}']:.3f}")
-        current_time = time()
+    quad_limits = get_branches_limits(network, monitored_branches_ids, current_limits)
 
-    # print(branches_sensitivities)
-
-    merged_json = {
-        "situationDescription":situation_description,
-        "sensitivities": {
-            "branch":branches_sensitivities,
-            "hvdc":ac_eq_sensitivities
-        },
-        "elemVars":elem_vars,
-        "quads":quad_limits
-    }
+    # One row per case (N first) with the type of the element in contingency
+    cases = pd.DataFrame({
+        "case": ["N"] + contingencies_ac_lines_ids + contingencies_hvdc_lines_ids + contingencies_transformer_ids,
+        "type": np.repeat(["", "ac_line", "hvdc_line", "transformer"],
+                          [1, len(contingencies_ac_lines_ids), len(contingencies_hvdc_lines_ids),
+                           len(contingencies_transformer_ids)])
+        })
 
     current_time = time()
+    case_parameters = {
+        "monitored_branches_ids":monitored_branches_ids,
+        "redispatchable_generators_ids":redispatchable_generators_ids,
+        "active_psts_ids":active_psts_ids,
+        "ac_eq_line_hvdc_lines_ids":ac_eq_line_hvdc_lines_ids,
+        "fict_gen":fict_gen,
+        "generators_for_ct":generators_for_ct,
+        "hvdc_emulation_lines_ids":hvdc_emulation_lines_ids,
+        "parameters":params,
+        "debug":debug
+        }
+    if batch_size is None:
+        if n_workers is None:
+            if executor is not None:
+                raise ValueError("The number of workers of the executor (n_workers) or the batch_size must be given")
+            n_workers = n_procs
+        batch_size = -(-len(cases) // n_workers)
+    batches = [cases.iloc[i:i + batch_size] for i in range(0, len(cases), batch_size)]
+    # Pool of the n_procs processes (the executor is owned by the caller), stopped even on error
+    pool = None
+    # The sensitivities of each case are written to a temporary file as soon as it is calculated, only
+    # their positions being kept in memory until the output file is written
+    fragments_file = tempfile.TemporaryFile()
+    try:
+        if executor is not None:
+            check_executor(executor)
+            network_buffer = network.save_to_binary_buffer("XIIDM").getvalue()
+            if hasattr(executor, "scatter"):
+                # dask Client, the tasks only get a reference to the buffer sent to each worker
+                network_buffer = executor.scatter(network_buffer, broadcast=True)
+            network_key = uuid.uuid4().hex
+            futures = [executor.submit(sensitivity_task, network_key, network_buffer, batch["case"].to_list(),
+                                       batch["type"].to_list(), case_parameters)
+                       for batch in batches]
+            batches_results = (future.result() for future in futures)
+        elif n_procs > 1:
+            # Each worker loads its own copy of the network once
+            pool = ProcessPoolExecutor(max_workers=n_procs, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=init_worker_network,
+                                       initargs=(network.save_to_binary_buffer("XIIDM").getvalue(),))
+            batches_results = pool.map(run_cases_in_worker, [batch["case"].to_list() for batch in batches],
+                                       [batch["type"].to_list() for batch in batches],
+                                       [case_parameters] * len(batches))
+        else:
+            batches_results = (run_cases(network, batch["case"].to_list(), batch["type"].to_list(),
+                                         **case_parameters)
+                               for batch in batches)
+        cases_results = itertools.chain.from_iterable(batches_results)
+
+        branches_sensitivities = {branch_name:{} for branch_name in monitored_branches_ids}
+        ac_eq_sensitivities = {hvdc_line:{} for hvdc_line in hvdc_emulation_lines_ids}
+        for (case_name, contingency_element_type), (branches_case_sensitivities, ac_eq_case_sensitivities,
+                                                    case_time) in zip(cases.itertuples(index=False), cases_results):
+            print(f"Contingency is {case_name} / {contingency_element_type}    {case_time:.3f}")
+            timers[f"Sensi for {case_name}"] = case_time
+            if branches_case_sensitivities is None:
+                continue
+            # Serialized and written to the temporary file as soon as the case is calculated
+            for branch_name, branch_sensitivities in branches_case_sensitivities.items():
+                branches_sensitivities[branch_name][case_name] = spool_json_fragment(
+                    fragments_file, to_json_fragment(branch_sensitivities, pretty))
+            for hvdc_name, hvdc_sensitivities in ac_eq_case_sensitivities.items():
+                ac_eq_sensitivities[hvdc_name][case_name] = spool_json_fragment(
+                    fragments_file, to_json_fragment(hvdc_sensitivities, pretty))
+
+        # print(branches_sensitivities)
+
+        merged_json = {
+            "situationDescription":situation_description,
+            "sensitivities": {
+                "branch":branches_sensitivities,
+                "hvdc":ac_eq_sensitivities
+            },
+            "elemVars":elem_vars,
+            "quads":quad_limits
+        }
 
-    name = round(situation_description["total_exchange"])
-    output_filepath = f"{data_folder}/{os.path.basename(network_path).split('.')[0]}_{name}" \
-                        f"{'setpoint' if force_setpoint else 'ac_emulation'}.json"
-    with open(output_filepath, 'w') as all_data_file:
-        json.dump(merged_json, all_data_file, indent=4, sort_keys=True)
-    print(f"File written at {os.path.abspath(output_filepath)}")
+        current_time = time()
 
-    timers["JSON writing"] = time() - current_time
+        name = round(situation_description["total_exchange"])
+        output_filepath = f"{data_folder}/{os.path.basename(network_path).split('.')[0]}_{name}" \
+                            f"{'setpoint' if force_setpoint else 'ac_emulation'}.json"
+        with open(output_filepath, 'w') as all_data_file:
+            write_json(all_data_file, merged_json, pretty=pretty)
+        print(f"File written at {os.path.abspath(output_filepath)}")
+
+        timers["JSON writing"] = time() - current_time
+    finally:
+        if pool is not None:
+            # Nothing is left to wait for, unless an error stopped the merge
+            pool.shutdown(cancel_futures=True)
+        fragments_file.close()
     current_time = time()
     print(timers)
     print(f"Total time spent {sum(k for k in timers.values()):.3f}\n"
-          f"Mean time spent for one case {sum(timers[f'Sensi for {contingency}'] for contingency in cases) / len(cases)}")
+          f"Mean time spent for one case {sum(timers[f'Sensi for {contingency}'] for contingency in cases['case']) / len(cases)}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -320,7 +596,9 @@ if __name__ == "__main__":
     HVDC_LINES = f"{DATA_FOLDER}/active_hvdc_lines.csv"
     HDVC_TARGET = None
     FORCE_SETPOINT = False
+    N_PROCS = 1
+    DEBUG = False
     main(DATA_FOLDER, IIDM_NAME, MONITORED_BRANCHES_PATH, CONTINGENCIES_PATH, HVDC_LINES,
          ACTIVE_PSTS_PATH, SLACK_BUS_PATH, REDISPATCHABLE_GENERATORS, HDVC_TARGET,
-         FORCE_SETPOINT, 500)
+         FORCE_SETPOINT, 500, N_PROCS, debug=DEBUG, pretty=DEBUG)
  
\ No newline at end of file
@@ -0,0 +1,28 @@
+import io
+import os
+import pytest
+import pypowsybl.network as nt
+from sensitivities.aux import adjust_network
+
+IIDM_PATH = os.path.join(os.path.dirname(__file__), "test_data/6_bus_system.xiidm")
+
+
+@pytest.fixture(scope="session")
+def ac_emulation_network_buffer():
+    """Returns the adjusted test network, with its HVDC lines in AC emulation (droop of 100MW/deg
+    and p0 of 150MW), saved once in a buffer (a new network being loaded from it for each use)"""
+    network = nt.load(IIDM_PATH)
+    network = adjust_network(network) # no loss on HVDCs
+    hvdc_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
+    hvdc_droop["droop"] = [100, 100]
+    hvdc_droop["p0"] = [150, 150]
+    hvdc_droop["enabled"] = [True, True]
+    network.update_extensions("hvdcAngleDroopActivePowerControl", hvdc_droop)
+    return network.save_to_binary_buffer("XIIDM").getvalue()
+
+
+@pytest.fixture(scope="module")
+def ac_emulation_network(ac_emulation_network_buffer):
+    """Returns a new network loaded from the buffer of ac_emulation_network_buffer for each module,
+    that can then create its own elements"""
+    return nt.load_from_binary_buffer(io.BytesIO(ac_emulation_network_buffer))
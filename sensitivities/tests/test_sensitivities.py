@@ -3,34 +3,69 @@ import pandas as pd
 import pytest
 import pypowsybl.network as nt
 import pypowsybl.loadflow as lf
+from pypowsybl._pypowsybl import PyPowsyblError
 import sys
 import os
+import io
+import json
+import tempfile
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from sensitivities.aux import calculate_exchange, create_ac_lines_to_simulate_hvdc_ac_emulation
-from sensitivities.aux import hvdc_lines_full_setpoint, add_exchange_sign_to_hvdc_df, adjust_network
+from sensitivities.aux import hvdc_lines_full_setpoint, add_exchange_sign_to_hvdc_df
 from sensitivities.aux import launch_sensitivity_analysis, get_hvdc_sensitivities_from_generators
 from sensitivities.aux import add_generators_at_hvdcs_extremities, get_pst_sensitivities
-from sensitivities.calculate_sensitivities import PARAMS
+from sensitivities.aux import get_network_snapshot, clear_network_snapshot, adjust_network
+from sensitivities.aux import apply_contingencies_modification, is_contingency_converged
+from sensitivities.aux import get_reference_flow_dictionnary, scoped_variant, define_slack_bus
+from sensitivities.calculate_sensitivities import make_params, write_json, to_json_fragment, with_max_iterations
+from sensitivities.calculate_sensitivities import spool_json_fragment
+from sensitivities.calculate_sensitivities import run_cases, run_one_case, check_executor, RETRY_MAX_ITERATIONS
 
 IIDM_PATH = os.path.join(os.path.dirname(__file__), "test_data/6_bus_system.xiidm")
+# Read once, the tests needing their own network (to create elements) load it from memory
+with open(IIDM_PATH) as iidm_file:
+    IIDM_CONTENT = iidm_file.read()
 # Being in AC (implying many non linearities), the tolerances are set quite high
 RELATIVE_TOL = 0.025
 ABSOLUTE_TOL = 0.01
 
-def test_ac_equivalent_line_gives_same_result_as_ac_emulation():
+
+def load_network() -> nt.Network:
+    """Returns a new network loaded from the content of the test file"""
+    return nt.load_from_string(os.path.basename(IIDM_PATH), IIDM_CONTENT)
+
+
+@pytest.fixture(scope="session")
+def base_network():
+    """Network loaded once, whose initial state is kept in the pristine variant"""
+    network = load_network()
+    network.clone_variant("InitialState", "pristine")
+    return network
+
+
+@pytest.fixture
+def network(base_network, request):
+    """Base network on a copy of its pristine variant, removed after the test
+    Only for tests modifying variant dependent values (not creating elements)"""
+    variant_id = f"test_{request.node.name}"
+    base_network.clone_variant("pristine", variant_id)
+    base_network.set_working_variant(variant_id)
+    yield base_network
+    base_network.set_working_variant("pristine")
+    base_network.remove_variant(variant_id)
+    base_network.per_unit = False
+
+
+def test_ac_equivalent_line_gives_same_result_as_ac_emulation(ac_emulation_network):
     """Test Loadflow before (AC emulation) and after (AC equivalent line and HVDC on p0 setpoint)
     is equivalent"""
-    network = nt.load(IIDM_PATH)
-    network = adjust_network(network)
+    network = ac_emulation_network
     network.per_unit = True
-    hvdc_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
-    active_hvdcs = list(hvdc_droop.index)
-    hvdc_droop["droop"] = [100, 100]
-    hvdc_droop["p0"] = [150, 150]
-    hvdc_droop["enabled"] = [True, True]
-    network.update_extensions("hvdcAngleDroopActivePowerControl", hvdc_droop)
+    active_hvdcs = list(network.get_extensions("hvdcAngleDroopActivePowerControl").index)
 
     network.clone_variant("InitialState", "Test")
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, make_params())
     vscs_before = network.get_vsc_converter_stations(attributes=["p"])
     hvdc_before = network.get_hvdc_lines(attributes=["converters_mode", "converter_station1_id",
                                                      "converter_station2_id", "connected1",
@@ -43,7 +78,7 @@ def test_ac_equivalent_line_gives_same_result_as_ac_emulation():
     ac_eq_hvdc = create_ac_lines_to_simulate_hvdc_ac_emulation(network, active_hvdcs)
     ac_eq_hvdc_name = ["ac_eq_line_" + hvdc for hvdc in ac_eq_hvdc]
     hvdc_lines_full_setpoint(network, active_hvdcs)
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, make_params())
     vscs_after = network.get_vsc_converter_stations(attributes=["p","q"])
     hvdc_after = network.get_hvdc_lines()
     hvdc_after = hvdc_after.join(vscs_after, on="converter_station1_id")
@@ -62,8 +97,128 @@ def test_ac_equivalent_line_gives_same_result_as_ac_emulation():
     pd.testing.assert_frame_equal(hvdc_after, hvdc_before, rtol=RELATIVE_TOL)
 
 
+def test_network_snapshot_is_reused_until_cleared(network):
+    """Test the snapshot of a network is only created once and holds the voltage levels countries"""
+    snapshot = get_network_snapshot(network)
+    assert get_network_snapshot(network) is snapshot
+    assert snapshot.voltage_levels.loc["ZEUSP6_S_VL6", "country"] == "ES"
+    assert snapshot.voltage_levels.loc["ULYSSP6_S_VL6", "country"] == "FR"
+
+    clear_network_snapshot(network)
+    assert get_network_snapshot(network) is not snapshot
+
+
+def test_network_snapshot_is_cleared_by_the_helpers_modifying_the_network():
+    """Test the snapshot is created again after each helper creating, connecting or disconnecting
+    elements (on a network of its own, elements being created)"""
+    network = load_network()
+    hvdc_lines_ids = ["HERA9AJAX1", "HERA9AJAX1bis"]
+    modifications = [
+        lambda: adjust_network(network),
+        lambda: create_ac_lines_to_simulate_hvdc_ac_emulation(network, hvdc_lines_ids),
+        lambda: add_generators_at_hvdcs_extremities(network, ["HERA9AJAX1"]),
+        lambda: define_slack_bus(network, "HADESP6_S_VL6", "HADESP6_S_VL6_TN1"),
+        lambda: apply_contingencies_modification(network, ["AJAXL71HADES_ACLS"], ["ac_line"], set(), False)
+        ]
+    for modification in modifications:
+        snapshot = get_network_snapshot(network)
+        modification()
+        assert get_network_snapshot(network) is not snapshot
+
+
+def test_apply_contingencies_modification_opens_and_closes_all_elements(network):
+    """Test several contingencies of different types are applied, then reverted, at once"""
+    case_names = ["N", "AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS", "HERA9AJAX1"]
+    contingency_element_types = ["", "ac_line", "ac_line", "hvdc_line"]
+
+    apply_contingencies_modification(network, case_names, contingency_element_types, set(), False)
+    branches = network.get_branches(attributes=["connected1", "connected2"])
+    hvdc_lines = network.get_hvdc_lines(attributes=["connected1", "connected2"])
+    assert not branches.loc[["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]].any(axis=None)
+    assert branches.drop(["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]).all(axis=None)
+    assert not hvdc_lines.loc["HERA9AJAX1"].any()
+    assert hvdc_lines.loc["HERA9AJAX1bis"].all()
+
+    apply_contingencies_modification(network, case_names, contingency_element_types, set(), True)
+    assert network.get_branches(attributes=["connected1", "connected2"]).all(axis=None)
+    assert network.get_hvdc_lines(attributes=["connected1", "connected2"]).all(axis=None)
+
+
+def test_scoped_variant_is_removed_even_on_error(network):
+    """Test the variant is only the working one inside the context, and is removed when leaving it"""
+    base_variant_id = network.get_working_variant_id()
+    with pytest.raises(ValueError):
+        with scoped_variant(network, base_variant_id, "scoped"):
+            assert network.get_working_variant_id() == "scoped"
+            network.update_lines(id="AJAXL71HADES_ACLS", connected1=False)
+            raise ValueError()
+    assert network.get_working_variant_id() == base_variant_id
+    assert "scoped" not in network.get_variant_ids()
+    assert network.get_lines(attributes=["connected1"]).loc["AJAXL71HADES_ACLS", "connected1"]
+
+
+def test_with_max_iterations_does_not_modify_parameters():
+    """Test the retry parameters are a modified copy of the given ones"""
+    params = make_params(read_slack_bus=False)
+    retry_params = with_max_iterations(params, 1000)
+    assert retry_params.provider_parameters["maxNewtonRaphsonIterations"] == "1000"
+    assert params.provider_parameters["maxNewtonRaphsonIterations"] == "500"
+    assert not retry_params.read_slack_bus
+
+
+def test_check_executor_only_accepts_processes_that_are_not_forked():
+    """Test the executors running the tasks in threads or forked processes are refused (no task
+    being submitted, nothing is started)"""
+    with ThreadPoolExecutor(1) as executor, pytest.raises(ValueError):
+        check_executor(executor)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("fork")) as executor, \
+            pytest.raises(ValueError):
+        check_executor(executor)
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as executor:
+        check_executor(executor)
+
+
+def test_write_json_gives_same_file_as_json_dump():
+    """Test the json written dictionary by dictionary, with already serialized values, is the same
+    as the one written at once"""
+    data = {
+        "sensitivities": {"branch": {"AJAXL71HADES_ACLS": {"N": {"HERA9AJAX1": 0.5, "referenceFlow": 1.25},
+                                                           "HERA9AJAX1bis": {}}},
+                          "hvdc": {}},
+        "quads": {"AJAXL71HADES_ACLS": {"permanent_limit": 2.8}},
+        "elemVars": {"pst": [], "counterTrading": None}
+    }
+    fragmented_data = {**data, "sensitivities": {
+        "branch": {"AJAXL71HADES_ACLS": {case: to_json_fragment(sensitivities) for case, sensitivities
+                                         in data["sensitivities"]["branch"]["AJAXL71HADES_ACLS"].items()}},
+        "hvdc": {}}}
+    json_file = io.StringIO()
+    write_json(json_file, fragmented_data)
+    assert json_file.getvalue() == json.dumps(data, indent=4, sort_keys=True)
+
+    compact_fragmented_data = {**data, "sensitivities": {
+        "branch": {"AJAXL71HADES_ACLS": {case: to_json_fragment(sensitivities, pretty=False) for case, sensitivities
+                                         in data["sensitivities"]["branch"]["AJAXL71HADES_ACLS"].items()}},
+        "hvdc": {}}}
+    json_file = io.StringIO()
+    write_json(json_file, compact_fragmented_data, pretty=False)
+    assert json_file.getvalue() == json.dumps(data, sort_keys=True, separators=(",", ":"))
+
+
+def test_write_json_reads_back_the_spooled_fragments():
+    """Test the fragments written to a temporary file are read back by write_json, at their place"""
+    sensitivities = {"N": {"HERA9AJAX1": 0.5, "referenceFlow": 1.25}, "HERA9AJAX1bis": {"HERA9AJAX1": -0.5}}
+    with tempfile.TemporaryFile() as fragments_file:
+        spooled_sensitivities = {case: spool_json_fragment(fragments_file, to_json_fragment(case_sensitivities))
+                                 for case, case_sensitivities in sensitivities.items()}
+        json_file = io.StringIO()
+        write_json(json_file, {"branch": {"AJAXL71HADES_ACLS": spooled_sensitivities}})
+    assert json_file.getvalue() == json.dumps({"branch": {"AJAXL71HADES_ACLS": sensitivities}}, indent=4,
+                                              sort_keys=True)
+
+
 @pytest.mark.parametrize("exchange_level", [100, 200, 500])
-def test_calculate_exchange_only_ac_lines(exchange_level):
+def test_calculate_exchange_only_ac_lines(network, exchange_level):
     """Test exchange level calculation with two AC lines connecting the border
     
     Network :       ES    /     FR
@@ -73,8 +228,6 @@ def test_calculate_exchange_only_ac_lines(exchange_level):
                      |        |
                      Aj       He
     """
-    network = nt.load(IIDM_PATH)
-
     gens = network.get_generators(attributes=["target_p"])
     loads = network.get_loads(attributes=["p0"])
     gens["target_p"] = [exchange_level, 0, 0, 0, 0, 0, 0, 0]
@@ -95,7 +248,7 @@ def test_calculate_exchange_only_ac_lines(exchange_level):
 
 
 @pytest.mark.parametrize("exchange_level", [100, 200, 500])
-def test_calculate_exchange_only_hvdc_lines(exchange_level):
+def test_calculate_exchange_only_hvdc_lines(network, exchange_level):
     """Test exchange level calculation with two HVDC lines in setpoint connecting the border
     
     Network :       ES    /     FR
@@ -105,13 +258,11 @@ def test_calculate_exchange_only_hvdc_lines(exchange_level):
                      |        |
      -exchange_level Aj- +/- -He
     """
-    network = nt.load(IIDM_PATH)
 
     gens = network.get_generators(attributes=["target_p"])
     loads = network.get_loads(attributes=["p0"])
     gens["target_p"] = [0, 0, 0, 0, exchange_level, 0, 0, 0]
     loads["p0"] = [0, 0, exchange_level, 0]
-    print(gens, loads)
     network.update_generators(gens)
     network.update_loads(loads)
 
@@ -131,7 +282,7 @@ def test_calculate_exchange_only_hvdc_lines(exchange_level):
 
 
 @pytest.mark.parametrize("exchange_level", [100, 200, 500])
-def test_calculate_exchange_only_hvdc_lines_opposite_direction(exchange_level):
+def test_calculate_exchange_only_hvdc_lines_opposite_direction(network, exchange_level):
     """Test exchange level calculation with two HVDC lines in setpoint connecting the border
     
     Network :       ES    /     FR
@@ -141,13 +292,11 @@ def test_calculate_exchange_only_hvdc_lines_opposite_direction(exchange_level):
                      |        |
                      Aj- +/- -He -exchange_level
     """
-    network = nt.load(IIDM_PATH)
 
     gens = network.get_generators(attributes=["target_p"])
     loads = network.get_loads(attributes=["p0"])
     gens["target_p"] = [0, 0, 0, 0, 0, exchange_level, 0, 0]
     loads["p0"] = [0, 0, 0, exchange_level]
-    print(gens, loads)
     network.update_generators(gens)
     network.update_loads(loads)
 
@@ -167,7 +316,7 @@ def test_calculate_exchange_only_hvdc_lines_opposite_direction(exchange_level):
 
 
 @pytest.mark.parametrize("exchange_level", [100, 200, 500])
-def test_calculate_exchange_ac_and_hvdc_lines(exchange_level):
+def test_calculate_exchange_ac_and_hvdc_lines(network, exchange_level):
     """Test exchange level calculation with two HVDC lines in AC emulation and 2 AC lines
     connecting the border
     
@@ -178,13 +327,11 @@ def test_calculate_exchange_ac_and_hvdc_lines(exchange_level):
                      |        |
      -exchange_level Aj- +/- -He
     """
-    network = nt.load(IIDM_PATH)
 
     gens = network.get_generators(attributes=["target_p"])
     loads = network.get_loads(attributes=["p0"])
     gens["target_p"] = [0, 0, 0, 0, exchange_level, 0, 0, 0]
     loads["p0"] = [0, 0, exchange_level, 0]
-    print(gens, loads)
     network.update_generators(gens)
     network.update_loads(loads)
 
@@ -202,37 +349,191 @@ def test_calculate_exchange_ac_and_hvdc_lines(exchange_level):
     assert pytest.approx(exchange_level, rel=RELATIVE_TOL) == exchange["total_exchange"]
 
 
+
+def test_sensitivity_analysis_with_contingency_gives_same_result_as_disconnection(network):
+    """Test the sensitivities calculated after a contingency by the sensitivity analysis are the ones
+    calculated on the network with the contingency applied"""
+    hvdc_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
+    hvdc_droop["enabled"] = [False, False]
+    network.update_extensions("hvdcAngleDroopActivePowerControl", hvdc_droop)
+    generator_name = "ATHEN7G6_NGU_SM"
+    monitored_branches = ["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]
+    contingency = "ZEUSL61ULYSS_ACLS"
+
+    result = launch_sensitivity_analysis(network, monitored_branches, [generator_name], [], [], make_params(),
+                                         {contingency: [contingency]})
+    assert is_contingency_converged(result, contingency)
+    _, gens_sensitivities, _ = get_hvdc_sensitivities_from_generators(result, pd.DataFrame(), {},
+                                                                      "generators", contingency)
+    ref_flow = get_reference_flow_dictionnary(result, "generators", contingency)
+
+    network.update_lines(id=contingency, connected1=False, connected2=False)
+    result_disconnected = launch_sensitivity_analysis(network, monitored_branches, [generator_name],
+                                                      [], [], make_params())
+    _, gens_sensitivities_disconnected, _ = get_hvdc_sensitivities_from_generators(
+        result_disconnected, pd.DataFrame(), {}, "generators")
+    ref_flow_disconnected = get_reference_flow_dictionnary(result_disconnected, "generators")
+    for branch in monitored_branches:
+        assert pytest.approx(gens_sensitivities_disconnected[branch][generator_name], abs=ABSOLUTE_TOL) == \
+            gens_sensitivities[branch][generator_name]
+        assert pytest.approx(ref_flow_disconnected[branch]["referenceCurrent"], rel=RELATIVE_TOL) == \
+            ref_flow[branch]["referenceCurrent"]
+
+
+def get_run_cases_inputs(monitored_branches_ids:list, read_slack_bus:bool):
+    """Returns a new network, with the AC equivalent lines of its HVDC lines (and a slack bus if
+    read_slack_bus), and the parameters of run_cases for its cases monitoring the given branches
+    The network is loaded on its own, run_one_case working on a copy of its initial variant"""
+    network = load_network()
+    hvdc_lines_ids = ["HERA9AJAX1", "HERA9AJAX1bis"]
+    create_ac_lines_to_simulate_hvdc_ac_emulation(network, hvdc_lines_ids)
+    hvdc_lines_full_setpoint(network, hvdc_lines_ids)
+    if read_slack_bus:
+        define_slack_bus(network, "HADESP6_S_VL6", "HADESP6_S_VL6_TN1")
+    case_parameters = {
+        "monitored_branches_ids":monitored_branches_ids,
+        "redispatchable_generators_ids":["ATHEN7G6_NGU_SM"],
+        "active_psts_ids":[],
+        "ac_eq_line_hvdc_lines_ids":[],
+        "fict_gen":pd.DataFrame(columns=["origin", "end"]),
+        "generators_for_ct":{},
+        "hvdc_emulation_lines_ids":[],
+        "parameters":make_params(read_slack_bus=read_slack_bus)
+        }
+    return network, case_parameters
+
+
+@pytest.fixture
+def one_by_one_case_names(monkeypatch):
+    """Names of the cases calculated by run_one_case from run_cases, in the order of the calls"""
+    case_names = []
+    def spied_run_one_case(network, case_name, *args, **kwargs):
+        case_names.append(case_name)
+        return run_one_case(network, case_name, *args, **kwargs)
+    monkeypatch.setattr("sensitivities.calculate_sensitivities.run_one_case", spied_run_one_case)
+    return case_names
+
+
+def assert_cases_results_are_run_one_case_ones(network, case_names:list, contingency_element_types:list,
+                                               cases_results:list, case_parameters:dict):
+    """Checks each case is given (none being dropped) with the sensitivities of run_one_case, within
+    the stop criterion of the loadflow (the sensitivities being rounded to 1e-6)"""
+    assert len(cases_results) == len(case_names)
+    for case_name, contingency_element_type, case_result in zip(case_names, contingency_element_types,
+                                                                cases_results):
+        branches_sensitivities, ac_eq_sensitivities, _ = case_result
+        expected_branches_sensitivities, expected_ac_eq_sensitivities, _ = \
+            run_one_case(network, case_name, contingency_element_type, **case_parameters)
+        assert branches_sensitivities is not None
+        assert ac_eq_sensitivities == expected_ac_eq_sensitivities
+        assert branches_sensitivities.keys() == expected_branches_sensitivities.keys()
+        for branch, sensitivities in branches_sensitivities.items():
+            assert sensitivities == pytest.approx(expected_branches_sensitivities[branch], rel=1e-5, abs=1e-6)
+
+
+@pytest.mark.parametrize("read_slack_bus", [True, False])
+def test_run_cases_gives_same_result_as_run_one_case(one_by_one_case_names, read_slack_bus:bool):
+    """Test the cases of a batch are calculated as one by one, in the same sensitivity analysis
+    only if the slack bus is read (the analysis selecting it on the N topology otherwise, the
+    contingency of HADESL71ATHEN_ACLS then changing the sensitivities)"""
+    network, case_parameters = get_run_cases_inputs(["HADESL71ATHEN_ACLS", "AJAXL71HADES_ACLS",
+                                                     "HERAL71ATHEN_ACLS"], read_slack_bus)
+    case_names = ["N", "ZEUSL61ULYSS_ACLS", "HADESL71ATHEN_ACLS", "HERA9AJAX1"]
+    contingency_element_types = ["", "ac_line", "ac_line", "hvdc_line"]
+
+    cases_results = run_cases(network, case_names, contingency_element_types, **case_parameters)
+    assert one_by_one_case_names == ([] if read_slack_bus else case_names)
+    assert_cases_results_are_run_one_case_ones(network, case_names, contingency_element_types, cases_results,
+                                               case_parameters)
+
+
+def test_run_cases_calculates_again_the_contingencies_without_flows(one_by_one_case_names):
+    """Test the contingency of the only monitored branch, whose reference flows are then all 0 (as
+    for a contingency whose loadflow does not converge), is calculated again by run_one_case"""
+    monitored_branch = "HADESL71ATHEN_ACLS"
+    network, case_parameters = get_run_cases_inputs([monitored_branch], True)
+    case_names = ["N", "ZEUSL61ULYSS_ACLS", monitored_branch, "HERA9AJAX1"]
+    contingency_element_types = ["", "ac_line", "ac_line", "hvdc_line"]
+
+    cases_results = run_cases(network, case_names, contingency_element_types, **case_parameters)
+    assert one_by_one_case_names == [monitored_branch]
+    assert_cases_results_are_run_one_case_ones(network, case_names, contingency_element_types, cases_results,
+                                               case_parameters)
+    assert cases_results[2][0][monitored_branch]["referenceCurrent"] == 0
+
+
+@pytest.fixture
+def analyses_max_iterations(monkeypatch, request):
+    """Maximum numbers of iterations of the sensitivity analyses launched by run_one_case, in the order
+    of the calls. The first analysis fails with the error given as parameter of the fixture (if any)"""
+    max_iterations = []
+    errors = [getattr(request, "param", None)]
+    def spied_launch_sensitivity_analysis(network, *args):
+        max_iterations.append(args[-1].provider_parameters["maxNewtonRaphsonIterations"])
+        error = errors.pop() if errors else None
+        if error is not None:
+            raise PyPowsyblError(error)
+        return launch_sensitivity_analysis(network, *args)
+    monkeypatch.setattr("sensitivities.calculate_sensitivities.launch_sensitivity_analysis",
+                        spied_launch_sensitivity_analysis)
+    return max_iterations
+
+
+def test_run_one_case_retries_with_more_iterations_if_the_maximum_is_reached(analyses_max_iterations):
+    """Test a case whose loadflow reaches the maximum number of iterations is only calculated again
+    with RETRY_MAX_ITERATIONS iterations"""
+    network, case_parameters = get_run_cases_inputs(["HADESL71ATHEN_ACLS"], True)
+    expected_branches_sensitivities, *_ = run_one_case(network, "ZEUSL61ULYSS_ACLS", "ac_line", **case_parameters)
+    analyses_max_iterations.clear()
+
+    case_parameters["parameters"] = with_max_iterations(case_parameters["parameters"], 2)
+    branches_sensitivities, *_ = run_one_case(network, "ZEUSL61ULYSS_ACLS", "ac_line", **case_parameters)
+    assert analyses_max_iterations == ["2", str(RETRY_MAX_ITERATIONS)]
+    assert branches_sensitivities["HADESL71ATHEN_ACLS"] == \
+        pytest.approx(expected_branches_sensitivities["HADESL71ATHEN_ACLS"], rel=1e-5, abs=1e-6)
+
+
+@pytest.mark.parametrize("analyses_max_iterations",
+                         ["Initial load flow of base situation ended with solver status SOLVER_FAILED"],
+                         indirect=True)
+def test_run_one_case_reapplies_the_contingency_if_the_loadflow_fails(analyses_max_iterations):
+    """Test a case whose loadflow fails for another reason than the maximum number of iterations is
+    calculated again after reapplying its contingency, without any retry with more iterations"""
+    network, case_parameters = get_run_cases_inputs(["HADESL71ATHEN_ACLS"], True)
+    branches_sensitivities, *_ = run_one_case(network, "ZEUSL61ULYSS_ACLS", "ac_line", **case_parameters)
+    assert analyses_max_iterations == ["500", "500"]
+    expected_branches_sensitivities, *_ = run_one_case(network, "ZEUSL61ULYSS_ACLS", "ac_line", **case_parameters)
+    assert branches_sensitivities["HADESL71ATHEN_ACLS"] == \
+        pytest.approx(expected_branches_sensitivities["HADESL71ATHEN_ACLS"], rel=1e-5, abs=1e-6)
+
+
 @pytest.mark.parametrize(["injection_variation", "distributed_slack"], [(1, True), (1, False),
                                                                         (-1, True), (-1, False),
                                                                         (10, True), (10, False),
                                                                         (-10, True), (-10, False)])
-def test_ac_line_sensitivity_calculation_generator_in_n(injection_variation:float, distributed_slack:bool):
+def test_ac_line_sensitivity_calculation_generator_in_n(network, injection_variation:float, distributed_slack:bool):
     """Test sensitivity calculation for a generator"""
-    network = nt.load(IIDM_PATH)
-    PARAMS.distributed_slack = distributed_slack
+    params = make_params(distributed_slack=distributed_slack)
     hvdc_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
     hvdc_droop["enabled"] = [False, False]
     network.update_extensions("hvdcAngleDroopActivePowerControl", hvdc_droop)
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     generator_name = "ATHEN7G6_NGU_SM"
     monitored_branches = ["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]
     branches_init_state = network.get_branches(attributes=["i1"]).loc[monitored_branches]
 
     result = launch_sensitivity_analysis(network, monitored_branches,
-                                         [generator_name], [], [], PARAMS)
+                                         [generator_name], [], [], params)
     _, gens_sensitivities, _ = get_hvdc_sensitivities_from_generators(result, pd.DataFrame(), {}, "generators")
-    print(gens_sensitivities)
 
     current_target = network.get_generators(attributes=["target_p"]).loc[generator_name]
     network.update_generators(id=generator_name, target_p=current_target + injection_variation)
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     branches_after = network.get_branches(attributes=["i1"])
     for branch in monitored_branches:
         assert pytest.approx(injection_variation * gens_sensitivities[branch][generator_name], abs=ABSOLUTE_TOL) == \
             (branches_after.loc[branch, "i1"] - branches_init_state.loc[branch, "i1"])
 
-    PARAMS.distributed_slack = False
-
 
 @pytest.mark.parametrize(["injection_variation", "distributed_slack"], [(1, True), (1, False),
                                                                         (-1, True), (-1, False),
@@ -240,8 +541,8 @@ def test_ac_line_sensitivity_calculation_generator_in_n(injection_variation:floa
                                                                         (-10, True), (-10, False)])
 def test_ac_line_sensitivity_calculation_hvdc_in_n(injection_variation:float, distributed_slack:bool):
     """Test sensitivity calculation for an hvdc"""
-    network = nt.load(IIDM_PATH)
-    PARAMS.distributed_slack = distributed_slack
+    network = load_network()
+    params = make_params(distributed_slack=distributed_slack)
     hvdc_droop = network.get_extensions("hvdcAngleDroopActivePowerControl")
     hvdc_droop["enabled"] = [False, False]
     network.update_extensions("hvdcAngleDroopActivePowerControl", hvdc_droop)
@@ -249,35 +550,31 @@ def test_ac_line_sensitivity_calculation_hvdc_in_n(injection_variation:float, di
     initial_target = 150
     network.update_hvdc_lines(id=["HERA9AJAX1", "HERA9AJAX1bis"], target_p=[initial_target]*2)
     hvdc_to_fict_gen = add_generators_at_hvdcs_extremities(network, [hvdc_name])
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     monitored_branches = ["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]
     branches_init_state = network.get_branches(attributes=["i1"]).loc[monitored_branches]
 
     result = launch_sensitivity_analysis(network, monitored_branches,
-                                         list(hvdc_to_fict_gen.loc[hvdc_name]), [], [], PARAMS)
+                                         list(hvdc_to_fict_gen.loc[hvdc_name]), [], [], params)
     hvdc_sensitivities, *_ = get_hvdc_sensitivities_from_generators(result, hvdc_to_fict_gen, {}, "generators")
-    print(hvdc_sensitivities)
 
     network.update_hvdc_lines(id="HERA9AJAX1", target_p=initial_target + injection_variation)
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     branches_after = network.get_branches(attributes=["i1"])
     for branch in monitored_branches:
         assert pytest.approx(injection_variation * hvdc_sensitivities[branch][hvdc_name], rel=RELATIVE_TOL) == \
             (branches_after.loc[branch, "i1"] - branches_init_state.loc[branch, "i1"])
 
-    PARAMS.distributed_slack = False
-
 
 @pytest.mark.parametrize(["tap_change", "distributed_slack"], [(1, True), (1, False),
                                                                (-1, True), (-1, False),
                                                             #    (5, True), (5, False),
                                                             #    (-5, True), (-5, False)
                                                                ])
-def test_ac_line_sensitivity_calculation_pst_in_n(tap_change:float, distributed_slack:bool):
+def test_ac_line_sensitivity_calculation_pst_in_n(network, tap_change:float, distributed_slack:bool):
     """Test sensitivity calculation for a pst"""
-    network = nt.load(IIDM_PATH)
     network.per_unit = False
-    PARAMS.distributed_slack = distributed_slack
+    params = make_params(distributed_slack=distributed_slack)
     pst_name = "NIREEL61ZEUS_ACLS"
     network.update_phase_tap_changers(id=pst_name, regulating=False, regulation_value=0,
                                       regulation_mode="FIXED_TAP", tap=10)
@@ -286,20 +583,17 @@ def test_ac_line_sensitivity_calculation_pst_in_n(tap_change:float, distributed_
     alpha_init = pst_angles.loc[(pst_name, 10), "alpha"]
     alpha_after = pst_angles.loc[(pst_name, 10 + tap_change), "alpha"]
     delta_alpha = alpha_after - alpha_init
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     monitored_branches = ["AJAXL71HADES_ACLS", "HADESL71ATHEN_ACLS"]
     branches_init_state = network.get_branches(attributes=["i1"]).loc[monitored_branches]
 
     result = launch_sensitivity_analysis(network, monitored_branches,
-                                         [], [pst_name], [], PARAMS)
+                                         [], [pst_name], [], params)
     pst_sensitivities = get_pst_sensitivities(result, "psts")
-    print(pst_sensitivities)
 
     network.update_phase_tap_changers(id=pst_name, tap=10 + tap_change)
-    lf.run_ac(network, PARAMS)
+    lf.run_ac(network, params)
     branches_after = network.get_branches(attributes=["i1"])
     for branch in monitored_branches:
         assert pytest.approx(branches_after.loc[branch, "i1"], rel=RELATIVE_TOL) == \
             branches_init_state.loc[branch, "i1"] + delta_alpha * pst_sensitivities[branch][pst_name]
-
-    PARAMS.distributed_slack = False